@@ -0,0 +1,122 @@
+"""
+NetworkManager that runs on an asyncio event loop instead of polling
+sockets. The lobby and all the games it hosts share one loop.
+"""
+
+import asyncio
+
+from network_manager import NetworkManager, Connection, ConnectionClosed
+
+
+class AsyncConnection(Connection):
+    """
+    Connection where conn is an asyncio transport instead of a socket.
+    """
+    def write(self, packet):
+        # The transport queues what it can't send right away
+        self.conn.write(packet)
+        if self.conn.get_write_buffer_size() > self.manager.maxOutbox:
+            if self.manager.verbose:
+                print("Dropping " + str(self.addr) + " for falling behind")
+            self.abort()
+
+    def fileno(self):
+        return self.conn.get_extra_info('socket').fileno()
+
+    def close(self):
+        self.conn.close()
+
+    def abort(self):
+        self.conn.abort()
+
+
+class Protocol(asyncio.Protocol):
+    """
+    Passes events from the event loop on to the NetworkManager.
+    """
+    def __init__(self, manager):
+        self.manager = manager
+
+    def connection_made(self, transport):
+        self.manager.tuneSocket(transport.get_extra_info('socket'))
+        transport.set_write_buffer_limits(
+            self.manager.highWaterMark, self.manager.lowWaterMark)
+        self.conn = self.manager.connectionClass(
+            transport, transport.get_extra_info('peername'))
+        self.manager.onConnectionMade(self.conn)
+
+    # Stop reading from a client while it isn't reading what we send it
+    def pause_writing(self):
+        self.conn.readPaused = True
+        self.conn.conn.pause_reading()
+
+    def resume_writing(self):
+        self.conn.readPaused = False
+        self.conn.conn.resume_reading()
+
+    def data_received(self, data):
+        self.manager.onDataReceived(self.conn, data)
+
+    def connection_lost(self, exc):
+        self.manager.onConnectionLost(self.conn)
+
+
+class AsyncNetworkManager(NetworkManager):
+    connectionClass = AsyncConnection
+
+    def startServer(self):
+        # The event loop takes over the socket in serve()
+        self.tuneSocket(self.sock)
+        self.sock.bind(("", self.port))
+        self.sock.listen(2)
+
+    async def serve(self):
+        """
+        Accept connections and handle their packets until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: Protocol(self), sock=self.sock)
+        async with server:
+            await server.serve_forever()
+
+    async def connect(self, addr):
+        self.isClient = True
+        loop = asyncio.get_running_loop()
+        await loop.create_connection(lambda: Protocol(self), *addr)
+
+    def addConnection(self, conn):
+        conn.manager = self
+        self.connections.append(conn)
+        self.watchIdle(conn)
+
+    def removeConnection(self, conn):
+        self.connections.remove(conn)
+        self.idleWheel.discard(conn)
+
+    def reap(self, conn):
+        # connection_lost cleans it up
+        conn.abort()
+
+    def callLater(self, delay, callback):
+        return asyncio.get_running_loop().call_later(delay, callback)
+
+    def recv(self, timeout=0):
+        raise RuntimeError(
+            "The event loop receives packets. Use serve() instead.")
+
+    def onConnectionMade(self, conn):
+        self.addConnection(conn)
+        if self.isClient:
+            self.onConnected()
+        else:
+            self.onClientConnected(conn)  # Do callback
+
+    def onDataReceived(self, conn, data):
+        self.dispatch(conn.manager, conn.manager.onGotData, conn, data)
+
+    def onConnectionLost(self, conn):
+        def closed():
+            raise ConnectionClosed(conn)
+
+        self.dispatch(conn.manager, closed)
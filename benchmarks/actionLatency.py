@@ -0,0 +1,106 @@
+"""
+Measure how long a client waits for the server to answer an action, and how
+much CPU an idle server uses.
+
+Compares the old loop (poll, then sleep 10 ms) with waiting on the sockets.
+Run from the repo root:
+    python -m benchmarks.actionLatency
+"""
+
+import statistics
+import threading
+import time
+import types
+
+import network
+
+
+class Counter:
+    """
+    Lobby stand-in. Answers requestNumPlayers like the real lobby.
+    """
+    def __init__(self, port=0):
+        self.networkManager = network.ServerNetworkManager(self, port)
+        self.networkManager.verbose = False
+        # We're the flood here
+        self.networkManager.rateLimits = {}
+
+    def onClientConnected(self, conn):
+        pass
+
+    def requestNumPlayers(self, addr):
+        for conn in self.networkManager.connections:
+            conn.updateNumPlayers(len(self.networkManager.connections))
+
+
+class Client:
+    def __init__(self, port):
+        for key in network.ClientNetworkManager.Opcodes.keys:
+            if not hasattr(self, key):
+                setattr(self, key,
+                        types.MethodType(lambda self, *a: None, self))
+        self.answered = False
+        self.networkManager = network.ClientNetworkManager(
+            self, 'localhost', port)
+        self.networkManager.connect(('localhost', port))
+
+    def updateNumPlayers(self, n):
+        self.answered = True
+
+    def act(self):
+        self.answered = False
+        self.networkManager.requestNumPlayers()
+        while not self.answered:
+            self.networkManager.recv(timeout=None)
+
+
+def pollingLoop(netman, stopped):
+    while not stopped.is_set():
+        netman.recv()
+        time.sleep(0.01)
+
+
+def waitingLoop(netman, stopped):
+    # Blocks in recv once stopped, which costs nothing
+    while not stopped.is_set():
+        netman.recv(timeout=None)
+
+
+def measure(loop, nActions=200, idleTime=1):
+    server = Counter()
+    port = server.networkManager.sock.getsockname()[1]
+    stopped = threading.Event()
+    threading.Thread(
+        target=loop, args=(server.networkManager, stopped),
+        daemon=True).start()
+    client = Client(port)
+
+    client.act()  # Warm up
+    latencies = []
+    for i in range(nActions):
+        start = time.perf_counter()
+        client.act()
+        latencies.append(time.perf_counter() - start)
+
+    # Only the server thread is running while we sleep
+    cpuStart = time.process_time()
+    time.sleep(idleTime)
+    idleCpu = (time.process_time() - cpuStart) / idleTime
+
+    stopped.set()
+    return latencies, idleCpu
+
+
+def report(name, latencies, idleCpu):
+    ms = sorted(x * 1000 for x in latencies)
+    print("%-8s mean %7.3f ms  p50 %7.3f ms  p99 %7.3f ms  idle cpu %5.2f%%" % (
+        name,
+        statistics.mean(ms),
+        ms[len(ms) // 2],
+        ms[int(len(ms) * 0.99)],
+        idleCpu * 100))
+
+
+if __name__ == '__main__':
+    report("poll", *measure(pollingLoop))
+    report("wait", *measure(waitingLoop))
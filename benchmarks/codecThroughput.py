@@ -0,0 +1,62 @@
+"""
+Compare the text and binary codecs on the packets a redraw sends.
+Run from the repo root:
+    python -m benchmarks.codecThroughput
+"""
+
+import random
+import timeit
+
+import network
+
+
+def redrawPackets():
+    """
+    Roughly what GameServer.redraw sends one player mid-game
+    """
+    def zone(n):
+        return [x for i in range(n)
+                for x in (random.randint(-1, 39), random.random() < 0.5)]
+
+    return [
+        [26, True],  # setActive
+        [19, 2],  # updatePhase
+        [11] + zone(4),  # updatePlayerFaceups
+        [12] + [False] * 4,  # updateHasAttacked
+        [13] + zone(3),  # updateEnemyFaceups
+        [7] + zone(6),  # updatePlayerHand
+        [9] + zone(2),  # updatePlayerFacedowns
+        [16, 7],  # updatePlayerManaCap
+        [17, 3],  # updatePlayerMana
+        [8] + zone(5),  # updateEnemyHand
+        [10] + zone(3),  # updateEnemyFacedowns
+        [18, 6],  # updateEnemyManaCap
+        [14] + zone(12),  # updatePlayerGraveyard
+        [15] + zone(10),  # updateEnemyGraveyard
+        [23],  # endRedraw
+    ]
+
+
+def text(packets):
+    for args in packets:
+        network.deserialize(network.serialize(args))
+
+
+def binary(packets):
+    for args in packets:
+        network.deserializeBinary(network.serializeBinary(args))
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    packets = redrawPackets()
+    n = 2000
+
+    for name, codec, size in (
+            ("text", text,
+             sum(len(network.serialize(p)) + 1 for p in packets)),
+            ("binary", binary,
+             sum(len(network.serializeBinary(p)) + 3 for p in packets))):
+        t = min(timeit.repeat(lambda: codec(packets), number=n, repeat=5))
+        print("%-6s %8.0f redraws/s  %6.2f us/packet  %4d bytes/redraw" % (
+            name, n / t, t / n / len(packets) * 1e6, size))
@@ -0,0 +1,35 @@
+"""
+Time making a player's deck, by building new cards from the faction's
+DeckSpec and by deep copying premade cards like we used to. Also shows
+how much memory each card's own attributes take.
+Run from the repo root:
+    python -m benchmarks.deckSetup
+"""
+
+import copy
+import sys
+import timeit
+
+from factions.templars import Templar
+from factions.mariners import Mariner
+from factions.thieves import Thief
+from factions.fae import Faerie
+
+
+if __name__ == '__main__':
+    n = 2000
+    for faction in (Templar, Mariner, Thief, Faerie):
+        spec = faction.deck
+        premade = list(spec.prototypes)
+        for name, make in (
+                ("deepcopy", lambda: copy.deepcopy(premade)),
+                ("build", spec.build),
+                ("player", faction)):
+            t = min(timeit.repeat(make, number=n, repeat=5))
+            print("%-9s %-8s %7.1f us" % (
+                faction.__name__, name, t * 1e6 / n))
+
+        cards = spec.build()
+        print("%-9s %d bytes of attributes per card" % (
+            faction.__name__,
+            sum(sys.getsizeof(c.__dict__) for c in cards) / len(cards)))
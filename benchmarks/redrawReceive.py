@@ -0,0 +1,91 @@
+"""
+Measure how long a client takes to receive redraws when it polls the
+network once a frame, like the Panda3D client does.
+
+Compares reading bufsize bytes per poll (the old way) with draining the
+socket each poll. Run from the repo root:
+    python -m benchmarks.redrawReceive
+"""
+
+import random
+import socket
+import time
+import types
+
+import network
+from network_manager import binaryFrame
+from benchmarks.codecThroughput import redrawPackets
+
+
+class Client:
+    """
+    Counts the redraws it gets and ignores everything else
+    """
+    def __init__(self):
+        for key in network.ClientNetworkManager.Opcodes.keys:
+            if not hasattr(self, key):
+                setattr(self, key,
+                        types.MethodType(lambda self, *a: None, self))
+        self.redraws = 0
+
+    def endRedraw(self):
+        self.redraws += 1
+
+
+def redrawBytes(nRedraws, binary):
+    data = bytearray()
+    for i in range(nRedraws):
+        for args in redrawPackets():
+            if binary:
+                data += binaryFrame(network.serializeBinary(args))
+            else:
+                data += bytes(network.serialize(args) + '\0', 'utf-8')
+    return bytes(data)
+
+
+def measure(drain, nRedraws, binary, frameTime=0.01):
+    """
+    Get the seconds and polls it takes to receive nRedraws redraws
+    """
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    base = Client()
+    netman = network.ClientNetworkManager(base, 'localhost', port)
+    netman.features = 0
+    netman.connect(('localhost', port))
+    netman.connections[0].binary = binary
+    if not drain:
+        netman.readBudget = netman.maxBufsize = netman.bufsize
+    server, addr = listener.accept()
+
+    data = redrawBytes(nRedraws, binary)
+    start = time.perf_counter()
+    server.sendall(data)
+    polls = 0
+    while True:
+        netman.recv()
+        polls += 1
+        if base.redraws == nRedraws:
+            break
+        time.sleep(frameTime)
+    elapsed = time.perf_counter() - start
+
+    server.close()
+    listener.close()
+    netman.sock.close()
+    return elapsed, polls, len(data)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    for binary in (False, True):
+        for nRedraws in (1, 10, 100):
+            for name, drain in (("1 read", False), ("drain", True)):
+                elapsed, polls, size = measure(drain, nRedraws, binary)
+                print("%-6s %3d redraws (%6d bytes)  %-6s  %7.1f ms  "
+                      "%3d polls" % (
+                          "binary" if binary else "text", nRedraws, size,
+                          name, elapsed * 1000, polls))
@@ -0,0 +1,135 @@
+"""
+Time whole games played by bots that make random legal moves, with
+Card.controller read through the card's zone and with the old search
+through the players' zones.
+Run from the repo root:
+    python -m benchmarks.simulatedGame
+"""
+
+import itertools
+import random
+import timeit
+
+from core.card import Card
+from core.exceptions import IllegalMoveError
+from core.game import Game, EndOfGame, Phase
+from factions.templars import Templar
+from factions.mariners import Mariner
+from factions.thieves import Thief
+from factions.fae import Faerie
+
+
+def searchController(self):
+    """
+    How Card.controller used to work
+    """
+    if self.game is None:
+        return self.owner
+
+    for pl in self.game.players:
+        if self.zone in pl.zones:
+            return pl
+
+    return self.owner
+
+
+def randomTarget(game, rng):
+    targets = [c for pl in game.players
+               for c in itertools.chain(pl.faceups, pl.facedowns)]
+    return rng.choice(targets) if len(targets) > 0 else None
+
+
+def replaceCards(pl, rng):
+    """
+    Answer any effects asking us to pick cards, e.g. from either hand
+    """
+    hands = list(pl.hand) + list(pl.opponent.hand)
+    for i in range(10):
+        if pl.replaceCallback is None:
+            return
+        n = pl.replaceCallback.__code__.co_argcount
+        try:
+            pl.replace(*rng.sample(hands, min(n, len(hands))))
+        except IllegalMoveError:
+            pass
+
+    # Nothing we picked worked, so skip it
+    pl.replaceCallback = None
+    pl.popAction()
+
+
+def tryMove(pl, rng, move, *args):
+    try:
+        move(*args)
+    except IllegalMoveError:
+        pass
+    replaceCards(pl, rng)
+
+
+def playTurn(game, rng):
+    pl = game.activePlayer
+    if game.phase == Phase.startOfTurn:
+        pl.endPhase()
+
+    # Reveal
+    for c in list(pl.facedowns):
+        if c.requiresTarget:
+            target = randomTarget(game, rng)
+            if target is not None:
+                tryMove(pl, rng, pl.revealFacedown, c, target)
+        else:
+            tryMove(pl, rng, pl.revealFacedown, c)
+    pl.endPhase()
+
+    # Play
+    if len(pl.hand) > 0:
+        tryMove(pl, rng, pl.play, rng.choice(pl.hand))
+    for c in list(pl.faceups):
+        if c.zone is pl.faceups and c.isUnit:
+            enemies = list(pl.opponent.faceups) + [pl.opponent.face]
+            tryMove(pl, rng, pl.attack, c, rng.choice(enemies))
+    pl.endTurn()
+
+
+def playGame(seed, factions, turns=200):
+    rng = random.Random(seed)
+    random.seed(seed)  # For shuffling
+    game = Game(*factions)
+    game.start()
+    for pl in game.players:
+        pl.mulligan()
+
+    try:
+        for turn in range(turns):
+            playTurn(game, rng)
+    except EndOfGame:
+        pass
+    return game
+
+
+def playGames(n=50):
+    factions = [Templar, Mariner, Thief, Faerie]
+    for seed in range(n):
+        playGame(seed, (factions[seed % 4], factions[seed // 4 % 4]))
+
+
+def readControllers(cards):
+    for c in cards:
+        c.controller
+
+
+if __name__ == '__main__':
+    # A board partway through a game
+    game = playGame(0, (Templar, Thief), turns=6)
+    cards = [c for pl in game.players for zone in pl.zones[1:] + [pl.deck]
+             for c in zone]
+
+    for name, controller in (
+            ("search", property(searchController)),
+            ("zone", Card.controller)):
+        Card.controller = controller
+        t = min(timeit.repeat(playGames, number=1, repeat=5))
+        read = min(timeit.repeat(
+            lambda: readControllers(cards), number=1000, repeat=5))
+        print("%-6s  %6.2f ms per game  %6.3f us per controller read" % (
+            name, t * 1000 / 50, read * 1e6 / 1000 / len(cards)))
@@ -0,0 +1,76 @@
+"""
+Measure action round trips over loopback with and without Nagle's
+algorithm, and with and without batched sends.
+
+Each action is answered with several small packets, like a redraw, and the
+client waits for the last one. Run from the repo root:
+    python -m benchmarks.socketOptions
+"""
+
+import threading
+import time
+
+import network
+from benchmarks.actionLatency import Client, waitingLoop
+
+
+class Redrawer:
+    """
+    Lobby stand-in. Answers requestNumPlayers with a burst of packets.
+    """
+    def __init__(self, batchSends, noDelay):
+        self.networkManager = network.ServerNetworkManager(self, 0)
+        # Accepted sockets get these
+        self.networkManager.batchSends = batchSends
+        self.networkManager.noDelay = noDelay
+        self.networkManager.rateLimits = {}
+
+    def onClientConnected(self, conn):
+        pass
+
+    def requestNumPlayers(self, addr):
+        conn = self.networkManager.connections.byAddr[addr]
+        with self.networkManager.batched(conn):
+            for i in range(8):
+                conn.updatePlayerMana(i)
+            conn.updateNumPlayers(len(self.networkManager.connections))
+
+
+def measure(batchSends, noDelay, nActions=300):
+    server = Redrawer(batchSends, noDelay)
+    port = server.networkManager.sock.getsockname()[1]
+    stopped = threading.Event()
+    threading.Thread(
+        target=waitingLoop, args=(server.networkManager, stopped),
+        daemon=True).start()
+    client = Client(port)
+    # The client's requests are single packets either way
+    client.networkManager.noDelay = noDelay
+    client.networkManager.tuneSocket(client.networkManager.sock)
+
+    client.act()  # Warm up
+    latencies = []
+    for i in range(nActions):
+        start = time.perf_counter()
+        client.act()
+        latencies.append(time.perf_counter() - start)
+
+    stopped.set()
+    # Wake the server up so it sees it's stopped
+    client.networkManager.requestNumPlayers()
+    return latencies
+
+
+def report(name, latencies):
+    ms = sorted(x * 1000 for x in latencies)
+    print("%-24s p50 %7.3f ms  p99 %7.3f ms" % (
+        name, ms[len(ms) // 2], ms[int(len(ms) * 0.99)]))
+
+
+if __name__ == '__main__':
+    for batchSends in (False, True):
+        for noDelay in (False, True):
+            report("%s, %s" % (
+                "batched" if batchSends else "unbatched",
+                "TCP_NODELAY" if noDelay else "Nagle"),
+                measure(batchSends, noDelay))
@@ -5,12 +5,31 @@ from direct.showbase.DirectObject import DirectObject
 from core.card import Card
 from core.game import EndOfGame
 from core.zone import Zone
+from network import ZoneOp
+
+
+def deferred(func):
+    """
+    Queue the instruction until endRedraw so a redraw is applied all at
+    once instead of showing half an update.
+    """
+    def fn(self, *args):
+        self.pending.append((func, args))
+
+    fn.__name__ = func.__name__
+    # So the network manager can tell how many args it takes
+    fn.__wrapped__ = func
+    return fn
 
 
 class NetworkInstructions(DirectObject):
     """
     Handles instructions from the server.
     """
+    def __init__(self):
+        super().__init__()
+        self.pending = []
+
     def onEnteredGame(self):
         base.onEnteredGame()
 
@@ -60,65 +79,100 @@ class NetworkInstructions(DirectObject):
 
         return c
 
+    @deferred
     def updatePlayerHand(self, *cardIds):
         base.player.hand[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.player.hand)
 
+    @deferred
     def updateEnemyHand(self, *cardIds):
         base.enemy.hand[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.enemy.hand)
 
+    @deferred
     def updatePlayerFacedowns(self, *cardIds):
         base.player.facedowns[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.player.facedowns)
 
+    @deferred
     def updateEnemyFacedowns(self, *cardIds):
         base.enemy.facedowns[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.enemy.facedowns)
 
+    @deferred
     def updatePlayerFaceups(self, *cardIds):
         base.player.faceups[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.player.faceups)
 
+    @deferred
+    def updateZone(self, zoneIndex, ofEnemy, *ops):
+        """
+        Apply the changes to a zone the server worked out with zoneDiff
+        """
+        zone = (base.enemy if ofEnemy else base.player).zones[zoneIndex]
+        ops = iter(ops)
+        for op in ops:
+            if op == ZoneOp.insert:
+                index = next(ops)
+                c, = self.idsToCards([next(ops), next(ops)])
+                # The zone it came from removes it with its own update
+                c._zone = zone
+                zone.insert(index, c)
+            elif op == ZoneOp.remove:
+                del zone[next(ops)]
+            elif op == ZoneOp.move:
+                index = next(ops)
+                zone.insert(next(ops), zone.pop(index))
+
+    @deferred
     def updateHasAttacked(self, *values):
         for i, c in enumerate(base.player.faceups):
             c.hasAttacked = values[i]
 
+    @deferred
     def updateEnemyFaceups(self, *cardIds):
         base.enemy.faceups[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.enemy.faceups)
 
+    @deferred
     def updatePlayerGraveyard(self, *cardIds):
         base.player.graveyard[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.player.graveyard)
 
+    @deferred
     def updateEnemyGraveyard(self, *cardIds):
         base.enemy.graveyard[:] = []
         for x in self.idsToCards(cardIds):
             self.moveCard(x, base.enemy.graveyard)
 
+    @deferred
     def updatePlayerManaCap(self, manaCap):
         base.player.manaCap = manaCap
 
+    @deferred
     def updatePlayerMana(self, mana):
         base.player.mana = mana
 
+    @deferred
     def updateEnemyManaCap(self, manaCap):
         base.enemy.manaCap = manaCap
 
+    @deferred
     def updatePhase(self, phase):
         base.phase = phase
 
+    @deferred
     def updatePlayerCounter(self, index, value):
         base.player.faceups[index].counter = value
 
+    @deferred
     def updateEnemyCounter(self, index, value):
         base.enemy.faceups[index].counter = value
 
@@ -140,8 +194,12 @@ class NetworkInstructions(DirectObject):
         base.guiScene.showBigMessage("Kicked")
         base.quitToMainMenu()
 
+    @deferred
     def setActive(self, value):
         base.active = value
 
     def endRedraw(self):
+        pending, self.pending = self.pending, []
+        for func, args in pending:
+            func(self, *args)
         base.redraw()
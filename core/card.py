@@ -1,3 +1,41 @@
+import types
+
+
+class CardAttribute:
+    """
+    Value of a card class's DSL attribute, stored once on the class.
+    Cards read it like one of their own until they set their own. The
+    class itself doesn't see it.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            raise AttributeError("Only cards have their DSL attributes")
+        return self.value
+
+
+def setCardAttributes(cls, attrs):
+    """
+    Store attrs on cls the way setting them on each card would. Setting
+    some, like rank, sets others instead.
+    """
+    # Not a card, so cards' attribute layout isn't based on it
+    scratch = types.SimpleNamespace()
+    for key, value in attrs.items():
+        attr = getattr(cls, key, None)
+        if isinstance(attr, property):
+            attr.fset(scratch, value)
+        else:
+            setattr(scratch, key, value)
+
+    for key, value in vars(scratch).items():
+        setattr(cls, key, CardAttribute(value))
+
+
 class Card:
     """
     A card has the following characteristics:
@@ -17,7 +55,8 @@ class Card:
         language.
         https://docs.python.org/3/reference/datamodel.html#object.__init_subclass__
         This method is called when a subclass of Card is created. It takes the
-        class variables of that card and makes them into instance variables.
+        class variables of that card and makes them into values every card
+        of the class shares, without copying them into each one.
         Look at the faction files for examples of how to use this.
         """
         super().__init_subclass__(**kwargs)  # Maintain compatibility
@@ -31,30 +70,14 @@ class Card:
         for key in newAttrs.keys():
             delattr(cls, key)
 
-        oldInit = cls.__init__
-
-        def __init__(self, **kwargs):
-            kwargs.update(newAttrs)
-            oldInit(self, **kwargs)
-
-        cls.__init__ = __init__
+        setCardAttributes(cls, newAttrs)
 
     def __init__(self, **kwargs):
-        self.name = "Placeholder Name"
-        self.image = "missing.png"
-        self.spell = False
-        self.continuous = False  # If spell, do we stay out after spawn
-        self.illusion = False  # If spell, do we die to attacks
-        self.cost = 0
-        self._rank = 0
-        self.fast = False
-        self.taunt = False
-        self.isValidTarget = True
+        # Only what changes during a game. The rest is on the class
         self.owner = None
         self.game = None
         self._zone = None
         self._visible = False
-        self.desc = ""
 
         for (key, value) in kwargs.items():
             setattr(self, key, value)
@@ -167,15 +190,11 @@ class Card:
 
     @property
     def controller(self):
-        # TODO: hack
-        if self.game is None:
+        # Whoever's zone we're in, e.g. after being stolen
+        if self.game is None or self._zone is None:
             return self.owner
 
-        for pl in self.game.players:
-            if self.zone in pl.zones:
-                return pl
-
-        return self.owner
+        return self._zone.controller
 
     @property
     def targetDesc(self):
@@ -191,3 +210,17 @@ class Card:
     @property
     def imagePath(self):
         return self.owner.iconPath + '/' + self.image
+
+
+setCardAttributes(Card, {
+    'name': "Placeholder Name",
+    'image': "missing.png",
+    'spell': False,
+    'continuous': False,  # If spell, do we stay out after spawn
+    'illusion': False,  # If spell, do we die to attacks
+    'cost': 0,
+    '_rank': 0,
+    'fast': False,
+    'taunt': False,
+    'isValidTarget': True,
+    'desc': ""})
@@ -1,11 +1,70 @@
+from copy import deepcopy
+
+
+class DeckSpec:
+    """
+    The cards a faction's deck starts with, as card classes and how many
+    of each. Players make their own cards from it with build(), which is
+    much faster than copying premade ones.
+    """
+    def __init__(self, entries=()):
+        # (card class, count) in deck order
+        self.entries = list(entries)
+        self._prototypes = None
+
+    def __add__(self, other):
+        if not isinstance(other, DeckSpec):
+            return NotImplemented
+        return DeckSpec(self.entries + other.entries)
+
+    def __len__(self):
+        return sum(count for cls, count in self.entries)
+
+    @property
+    def prototypes(self):
+        """
+        One card for each in the deck, to look things up in, e.g. the name
+        of the card with some cardId. Not for playing with.
+        """
+        if self._prototypes is None:
+            self._prototypes = self.build()
+        return self._prototypes
+
+    def __getitem__(self, index):
+        return self.prototypes[index]
+
+    def __iter__(self):
+        return iter(self.prototypes)
+
+    def build(self):
+        """
+        Make new cards for a player
+        """
+        return [cls() for cls, count in self.entries for i in range(count)]
+
+
 def deck(*args):
-    deck = []
+    """
+    Make a DeckSpec from card classes, each optionally followed by how
+    many of it there are, e.g. deck(corvus, 5, archangel)
+    """
+    entries = []
 
     for i, arg in enumerate(args):
         if hasattr(arg, '__call__'):
             if i + 1 < len(args) and isinstance(args[i + 1], int):
-                deck += [arg() for i in range(args[i + 1])]
+                entries.append((arg, args[i + 1]))
             else:
-                deck.append(arg())
+                entries.append((arg, 1))
+
+    return DeckSpec(entries)
+
 
-    return deck
+def newCards(deck):
+    """
+    Make a player's cards from their class's deck. That can also be a list
+    of premade cards, e.g. in tests, which are copied.
+    """
+    if isinstance(deck, DeckSpec):
+        return deck.build()
+    return deepcopy(deck)
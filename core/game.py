@@ -8,6 +8,23 @@ def destroy(card):
     card.game.destroy(card)
 
 
+# Whether each class has each event trigger
+triggerCache = {}
+
+
+def hasTrigger(obj, name):
+    """
+    Whether obj has a method for the event name, e.g. afterEndTurn.
+    Triggers are defined on classes, so we only look once per class.
+    """
+    key = (obj.__class__, name)
+    try:
+        return triggerCache[key]
+    except KeyError:
+        result = triggerCache[key] = hasattr(obj.__class__, name)
+        return result
+
+
 class EndOfGame(BaseException):
     def __init__(self, winner):
         self.winner = winner
@@ -59,16 +76,15 @@ class Game:
         return None if self.turn is None else self.players[self.turn]
 
     def doEventTriggers(self, name, *args, **kwargs):
-        # Find the right function by name and call it
-        # If it doesn't exist, don't worry about it
-        def doTrigger(obj, name):
-            if hasattr(obj, name):
-                getattr(obj, name)(*args, **kwargs)
-
+        # Call the players' and faceups' functions for the event, if they
+        # have one. The faceups keep track of which of them do
         for pl in self.players:
-            doTrigger(pl, name)
-            for c in pl.faceups[:]:
-                doTrigger(c, name)
+            if hasTrigger(pl, name):
+                getattr(pl, name)(*args, **kwargs)
+            listeners = pl.faceups.listeners(name)
+            if len(listeners) > 0:
+                for c in listeners[:]:
+                    getattr(c, name)(*args, **kwargs)
 
     def fight(self, c1, c2):
         self.doEventTriggers('beforeAnyFight', c1, c2)
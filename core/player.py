@@ -5,11 +5,11 @@ A player has the following characteristics:
     Mana cap
     Mana
 """
-from copy import deepcopy
 from random import randint
 
 from core.game import Phase
-from core.zone import Zone
+from core.zone import Zone, FaceupZone
+from core.faction import newCards
 from core.exceptions import IllegalMoveError
 
 startHandSize = 5
@@ -23,10 +23,10 @@ class Player:
     def __init__(self):
         self.hand = Zone(self)
         self.facedowns = Zone(self)
-        self.faceups = Zone(self)
+        self.faceups = FaceupZone(self)
         # Need to have a dummy zone to attack
         self.face = Zone(self, ["A human face."])
-        self.deck = Zone(self, deepcopy(self.deck))  # deck is initially a class var
+        self.deck = Zone(self, newCards(self.deck))  # deck is initially a class var
 
         self.graveyard = Zone(self)
         self._manaCap = 1
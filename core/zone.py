@@ -1,10 +1,12 @@
 import random
-from core.game import destroy
+from core.game import destroy, hasTrigger
 
 
 class Zone(list):
     def __init__(self, controller, lst=[]):
         super().__init__(lst)
+        # The player whose zone this is. Cards in it are theirs to use
+        self.controller = controller
         self.dirty = True
 
     def __setitem__(self, key, value):
@@ -35,3 +37,76 @@ class Zone(list):
 
     def shuffle(self):
         random.shuffle(self)
+
+
+class FaceupZone(Zone):
+    """
+    Zone whose cards get event triggers. Remembers which of its cards have
+    a trigger for each event, in zone order, so events only look at them.
+    """
+    def __init__(self, controller, lst=[]):
+        super().__init__(controller, lst)
+        # Event name -> cards with a trigger for it. Filled in as events
+        # are asked about
+        self.triggers = {}
+
+    def listeners(self, name):
+        """
+        Get the cards with a trigger for the event name, in zone order
+        """
+        try:
+            return self.triggers[name]
+        except KeyError:
+            cards = self.triggers[name] = [
+                c for c in self if hasTrigger(c, name)]
+            return cards
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.triggers.clear()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.triggers.clear()
+
+    def insert(self, index, card):
+        super().insert(index, card)
+        self.triggers.clear()
+
+    def pop(self, index=-1):
+        card = super().pop(index)
+        self.triggers.clear()
+        return card
+
+    def extend(self, cards):
+        super().extend(cards)
+        self.triggers.clear()
+
+    def __iadd__(self, cards):
+        super().__iadd__(cards)
+        self.triggers.clear()
+        return self
+
+    def clear(self):
+        super().clear()
+        self.triggers.clear()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.triggers.clear()
+
+    def reverse(self):
+        super().reverse()
+        self.triggers.clear()
+
+    def append(self, card):
+        super().append(card)
+        for name, cards in self.triggers.items():
+            if hasTrigger(card, name):
+                cards.append(card)
+
+    def remove(self, card):
+        super().remove(card)
+        for cards in self.triggers.values():
+            if card in cards:
+                cards.remove(card)
@@ -1,4 +1,5 @@
 from core.game import destroy
+from core.faction import deck
 import core.card
 
 
@@ -62,4 +63,4 @@ class mindControlTrap(Card):
         enemy.zone = self.controller.faceups
 
 
-deck = [sweep(), spellBlade(), mindControlTrap()]
+deck = deck(sweep, spellBlade, mindControlTrap)
@@ -5,9 +5,10 @@ Takes the client's actions and computes the results, then sends them back.
 
 import traceback
 import random
-import time
 import inspect
+from collections import Counter
 
+from network import Features, ZoneOp
 from network_manager import ConnectionClosed
 from core.game import Game, EndOfGame
 from core.exceptions import IllegalMoveError
@@ -23,6 +24,12 @@ class ServerError(BaseException):
 
 
 Zone = numericEnum('face', 'faceup', 'facedown', 'hand', 'graveyard')
+# For the names of the opcodes that update a whole zone
+zoneNames = {
+    Zone.faceup: 'Faceups',
+    Zone.facedown: 'Facedowns',
+    Zone.hand: 'Hand',
+    Zone.graveyard: 'Graveyard'}
 
 
 availableFactions = [Templar, Mariner, Thief, Faerie]
@@ -43,6 +50,39 @@ def getZone(player, zone):
     return [i for c in zone for i in getCard(player, c)]
 
 
+def zoneDiff(old, new):
+    """
+    Get the ops that turn the zone old into new, flattened for updateZone.
+    Both are lists of (cardId, ownedByEnemy) pairs.
+    """
+    cur = list(old)
+    ops = []
+
+    # Take out cards that aren't there any more. Go back to front so the
+    # indices we send stay valid
+    removed = Counter(old) - Counter(new)
+    for i in reversed(range(len(cur))):
+        if removed[cur[i]]:
+            removed[cur[i]] -= 1
+            del cur[i]
+            ops += [ZoneOp.remove, i]
+
+    for i, card in enumerate(new):
+        if i < len(cur) and cur[i] == card:
+            continue
+
+        try:
+            j = cur.index(card, i + 1)
+        except ValueError:
+            cur.insert(i, card)
+            ops += [ZoneOp.insert, i, *card]
+        else:
+            cur.insert(i, cur.pop(j))
+            ops += [ZoneOp.move, j, i]
+
+    return ops
+
+
 def ZIEToCard(pl, targetZone, targetIndex, targetsEnemy):
     if targetZone == -1:
         return None
@@ -84,15 +124,23 @@ def acceptsTarget(func):
 
         func(self, *args[:nArgs], target)
 
+    # So the network manager can tell how many args it takes
+    converted.__wrapped__ = func
+    converted.acceptsTarget = True
     return converted
 
 
 class GameServer:
-    def __init__(self, netman):
+    def __init__(self, netman, onFinished=None):
         self.networkManager = netman
         self.networkManager.base = self
+        # Set when the lobby hosts us in its own process
+        self.onFinished = onFinished
+        self.finished = False
         self.addrs = [c.addr for c in self.networkManager.connections]
         self.factions = [None, None]
+        # What each client was last told was in each zone
+        self.sentZones = {}
 
         for conn in self.networkManager.connections:
             conn.onEnteredGame()
@@ -165,8 +213,10 @@ class GameServer:
                 c.updateBothPlayersMulliganed()
             self.redraw()
         else:
-            self.connections[addr].updatePlayerHand(*getZone(pl, pl.hand))
-            self.connections[addr].endRedraw()
+            c = self.connections[addr]
+            with self.networkManager.batched(c):
+                self.updateZone(c, pl, Zone.hand, False)
+                c.endRedraw()
 
     @acceptsTarget
     def revealFacedown(self, addr, index, target=None):
@@ -225,61 +275,77 @@ class GameServer:
         pl = self.players[addr]
         pl.thiefAbility(
             pl.hand[discardIndex],
-            pl.opponent.__class__.deck[guessId].name,
+            pl.opponent.referenceDeck[guessId].name,
             pl.opponent.facedowns[targetIndex])
         self.redraw()
 
+    def updateZone(self, c, pl, zoneIndex, ofEnemy):
+        """
+        Tell c what's in one of the zones, as pl sees it.
+        If c supports deltas, only send what changed since last time.
+        """
+        zone = (pl.opponent if ofEnemy else pl).zones[zoneIndex]
+        cards = getZone(pl, zone)
+
+        if c.features & Features.delta:
+            key = (c.addr, zoneIndex, ofEnemy)
+            old = self.sentZones.get(key, [])
+            new = list(zip(cards[::2], cards[1::2]))
+            ops = zoneDiff(old, new)
+            if ops:
+                c.updateZone(zoneIndex, ofEnemy, *ops)
+            self.sentZones[key] = new
+        else:
+            getattr(c, 'update' + ('Enemy' if ofEnemy else 'Player') +
+                    zoneNames[zoneIndex])(*cards)
+
+    def updateDirtyZone(self, c, pl, zoneIndex, ofEnemy):
+        zone = (pl.opponent if ofEnemy else pl).zones[zoneIndex]
+        if zone.dirty:
+            self.updateZone(c, pl, zoneIndex, ofEnemy)
+
     def redraw(self):
         for addr, pl in self.players.items():
             c = self.connections[addr]
-            enemyPlayer = pl.opponent
+            # Send the whole update in one write
+            with self.networkManager.batched(c):
+                enemyPlayer = pl.opponent
 
-            c.setActive(int(pl.active))
-            c.updatePhase(self.game.phase)
+                c.setActive(int(pl.active))
+                c.updatePhase(self.game.phase)
 
-            if pl.faceups.dirty:
-                c.updatePlayerFaceups(*getZone(pl, pl.faceups))
+                self.updateDirtyZone(c, pl, Zone.faceup, False)
 
-            for i, card in enumerate(pl.faceups):
-                if hasattr(card, 'counter'):
-                    c.updatePlayerCounter(i, card.counter)
+                for i, card in enumerate(pl.faceups):
+                    if hasattr(card, 'counter'):
+                        c.updatePlayerCounter(i, card.counter)
 
-            c.updateHasAttacked(*(c.hasAttacked for c in pl.faceups))
+                c.updateHasAttacked(*(c.hasAttacked for c in pl.faceups))
 
-            if enemyPlayer.faceups.dirty:
-                c.updateEnemyFaceups(
-                    *getZone(pl, enemyPlayer.faceups))
+                self.updateDirtyZone(c, pl, Zone.faceup, True)
 
-            for i, card in enumerate(pl.opponent.faceups):
-                if hasattr(card, 'counter'):
-                    c.updateEnemyCounter(i, card.counter)
+                for i, card in enumerate(pl.opponent.faceups):
+                    if hasattr(card, 'counter'):
+                        c.updateEnemyCounter(i, card.counter)
 
-            if pl.hand.dirty:
-                c.updatePlayerHand(*getZone(pl, pl.hand))
-            if pl.facedowns.dirty:
-                c.updatePlayerFacedowns(*getZone(pl, pl.facedowns))
+                self.updateDirtyZone(c, pl, Zone.hand, False)
+                self.updateDirtyZone(c, pl, Zone.facedown, False)
 
-            c.updatePlayerManaCap(pl.manaCap)
-            c.updatePlayerMana(pl.mana)
+                c.updatePlayerManaCap(pl.manaCap)
+                c.updatePlayerMana(pl.mana)
 
-            if enemyPlayer.hand.dirty:
-                c.updateEnemyHand(*getZone(pl, enemyPlayer.hand))
-            if enemyPlayer.facedowns.dirty:
-                c.updateEnemyFacedowns(
-                    *getZone(pl, enemyPlayer.facedowns))
+                self.updateDirtyZone(c, pl, Zone.hand, True)
+                self.updateDirtyZone(c, pl, Zone.facedown, True)
 
-            c.updateEnemyManaCap(enemyPlayer.manaCap)
+                c.updateEnemyManaCap(enemyPlayer.manaCap)
 
-            if pl.graveyard.dirty:
-                c.updatePlayerGraveyard(*getZone(pl, pl.graveyard))
-            if enemyPlayer.graveyard.dirty:
-                c.updateEnemyGraveyard(
-                    *getZone(pl, pl.opponent.graveyard))
+                self.updateDirtyZone(c, pl, Zone.graveyard, False)
+                self.updateDirtyZone(c, pl, Zone.graveyard, True)
 
-            c.endRedraw()
+                c.endRedraw()
 
-            if pl.replaceCallback is not None:
-                c.requestReplace(pl.replaceCallback.__code__.co_argcount)
+                if pl.replaceCallback is not None:
+                    c.requestReplace(pl.replaceCallback.__code__.co_argcount)
 
         for pl in self.game.players:
             for z in pl.zones:
@@ -297,37 +363,65 @@ class GameServer:
         for c in self.networkManager.connections:
             c.kick()
 
-    def run(self):
-        while 1:
+    def guard(self, func, *args):
+        """
+        Run func (usually networkManager.recv), dealing with any errors the
+        players cause.
+        """
+        try:
+            func(*args)
+        except IndexError as e:
+            print(e)
+        except IllegalMoveError as e:  # Client sent us an illegal move
+            print(e)
+        except EndOfGame as e:
             try:
-                self.networkManager.recv()
-            except IndexError as e:
-                print(e)
-            except IllegalMoveError as e:  # Client sent us an illegal move
-                print(e)
-            except EndOfGame as e:
                 self.endGame(e.winner)
-                exit(0)
-            except ConnectionClosed as c:
-                if c in self.networkManager.connections:
-                    self.networkManager.connections.remove(c)
-                # If you DC, your opponent wins
-                if hasattr(self, 'players'):
-                    try:
-                        self.endGame(self.players[c.conn.addr].opponent)
-                    except (BrokenPipeError, ConnectionClosed):
-                        # Opponent also DC'd
-                        pass
-                else:
-                    try:
-                        self.kickEveryone()
-                    except (BrokenPipeError, ConnectionClosed):
-                        pass
-                exit(0)
-            except Exception as e:  # We died due to some other error
-                print(e)
-                print(traceback.format_exc())
+            except (OSError, ConnectionClosed):
+                # recv will find out who it was
+                pass
+            self.finish(0)
+        except ConnectionClosed as c:
+            if c.conn in self.networkManager.connections:
+                self.networkManager.removeConnection(c.conn)
+            # If you DC, your opponent wins
+            if hasattr(self, 'players'):
+                try:
+                    self.endGame(self.players[c.conn.addr].opponent)
+                except (OSError, ConnectionClosed):
+                    # Opponent also DC'd
+                    pass
+            else:
+                try:
+                    self.kickEveryone()
+                except (OSError, ConnectionClosed):
+                    pass
+            c.conn.close()
+            self.finish(0)
+        except Exception as e:  # We died due to some other error
+            print(e)
+            print(traceback.format_exc())
+            try:
                 self.kickEveryone()
-                exit(1)
+            except (OSError, ConnectionClosed):
+                pass
+            self.finish(1)
 
-            time.sleep(0.01)
+    def finish(self, status):
+        """
+        Exit if we have our own process, otherwise tell the lobby we're done.
+        Only the first call counts.
+        """
+        if self.finished:
+            return
+        self.finished = True
+
+        if self.onFinished is None:
+            exit(status)
+        else:
+            self.onFinished(self, status)
+
+    def run(self):
+        while 1:
+            # Sleep until a player does something
+            self.guard(self.networkManager.recv, None)
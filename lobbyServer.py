@@ -1,108 +1,269 @@
 """
 Use this if you want to run multiple matches at once
 This is the way you should usually run the server
+
+Games are hosted in the lobby's process, sharing its event loop.
+Pass --fork to fork one process per game instead, or --workers N to
+hand games to a pool of N worker processes started up front.
+Pass --shards N to run N lobby processes sharing the port.
+Pass --idle-timeout N to drop players who are quiet for N seconds and
+don't answer a ping (default 60), or 0 to never drop them. Clients too
+old to answer pings are left to TCP keepalive instead.
+Pass --asyncio to run on an asyncio event loop instead of a selector.
+--fork, --workers and --shards don't work with --asyncio.
 """
 
 import os
 import sys
-import copy
 import random
-import time
+import asyncio
 import network
 
 from network_manager import ConnectionClosed
-from network import ServerNetworkManager
+from network import ServerNetworkManager, AsyncServerNetworkManager
+from async_network_manager import AsyncNetworkManager
 from gameServer import GameServer
+from workerPool import WorkerPool
+from matchmaking import MatchQueue
+from lobbyShards import ShardLink, runShards
 
 
 class LobbyServer:
-    def __init__(self, argv):
-        self.networkManager = ServerNetworkManager(self)
-        self.readyPlayers = []
+    def __init__(self, argv, port=None, shard=None):
+        """
+        shard is the control socket from the coordinator if we're one of
+        several lobby shards. See lobbyShards.py
+        """
+        if '--asyncio' in argv:
+            self.networkManager = AsyncServerNetworkManager(self, port)
+        else:
+            self.networkManager = ServerNetworkManager(
+                self, port, reusePort=shard is not None)
+        self.readyPlayers = MatchQueue()
+        self.matchScheduled = False
         self.gameServerProcs = {}
+        self.hostedGames = set()
+        # How often to check for finished games while any are running
+        self.reapInterval = 0.1
         self.verbose = self.networkManager.verbose = '-v' in argv
+        idleTimeout = 60
+        if '--idle-timeout' in argv:
+            idleTimeout = float(argv[argv.index('--idle-timeout') + 1])
+        self.networkManager.idleTimeout = idleTimeout or None
+        # Whether games run in our process rather than a forked one.
+        # Forking is only supported without asyncio
+        self.hostsGames = (
+            '--fork' not in argv or
+            isinstance(self.networkManager, AsyncNetworkManager))
+        self.workerPool = None
+        if '--workers' in argv:
+            self.workerPool = WorkerPool(
+                self.networkManager,
+                int(argv[argv.index('--workers') + 1]),
+                self.onPlayersReturned)
+        # How long to wait to send changes in the number of players, so
+        # many changes go out as one
+        self.countInterval = 0.25
+        self.countScheduled = False
+        # The number of players each client was last told
+        self.sentCounts = {}
+        # How many updateNumPlayers were sent and how many weren't, since
+        # the client already knew
+        self.countsSent = 0
+        self.countsSuppressed = 0
+        self.shard = None
+        if shard is not None:
+            self.shard = ShardLink(self, shard)
+
+    @property
+    def numPlayers(self):
+        """
+        Players in the lobby, including other shards'
+        """
+        if self.shard is not None:
+            return self.shard.total
+        return len(self.networkManager.connections)
 
     def onClientConnected(self, conn):
-        for conn in self.networkManager.connections:
-            conn.updateNumPlayers(len(self.networkManager.connections))
+        self.updateNumPlayers()
         if self.verbose:
             print("Client connected from " + str(conn.addr))
 
     def requestNumPlayers(self, addr):
-        for conn in self.networkManager.connections:
-            try:
-                conn.updateNumPlayers(len(self.networkManager.connections))
-            except (ConnectionResetError, BrokenPipeError):
-                print("connection reset")
-                pass  # If they dc'd, don't worry about it
+        conn = self.networkManager.connections.byAddr[addr]
+        conn.updateNumPlayers(self.numPlayers)
+        self.sentCounts[conn] = self.numPlayers
 
     def updateNumPlayers(self):
-        self.requestNumPlayers(None)
+        """
+        Let everyone know how many players there are, after countInterval.
+        Changes until then go out together.
+        """
+        self.updateShard()
+        if not self.countScheduled:
+            self.networkManager.callLater(self.countInterval, self.sendCounts)
+            self.countScheduled = True
+
+    def sendCounts(self):
+        """
+        Send the number of players to everyone who doesn't know it yet
+        """
+        self.countScheduled = False
+        n = self.numPlayers
+        for conn in self.networkManager.connections:
+            if self.sentCounts.get(conn) == n:
+                self.countsSuppressed += 1
+            else:
+                conn.updateNumPlayers(n)
+                self.countsSent += 1
+        # Forget players who left
+        self.sentCounts = dict.fromkeys(self.networkManager.connections, n)
+
+    def updateShard(self):
+        """
+        Tell the coordinator how many players we have, and whether one is
+        waiting for someone to play.
+        """
+        if self.shard is not None:
+            self.shard.reportCount(len(self.networkManager.connections))
+            self.shard.setWaiting(len(self.readyPlayers) == 1)
 
     def addPlayer(self, addr):
-        conn = next(
-            conn for conn in self.networkManager.connections
-            if conn.addr == addr)
-        if conn not in self.readyPlayers:
-            self.readyPlayers.append(conn)
-
-    def acceptConnections(self):
-        self.networkManager.accept()
+        conn = self.networkManager.connections.byAddr[addr]
+        self.readyPlayers.add(conn)
+
+        # Wait until we've handled everything we just received
+        if not self.matchScheduled:
+            self.networkManager.callLater(0, self.matchPlayers)
+            self.matchScheduled = True
+
+    def guard(self, func, *args):
+        """
+        Run func (usually networkManager.recv), dealing with any errors
+        clients cause.
+        """
         try:
-            self.networkManager.recv()
+            func(*args)
         except network.OpcodeError as e:
             print(e)
         except ConnectionClosed as c:
-            self.networkManager.connections.remove(c.conn)
-            try:
-                self.readyPlayers.remove(c.conn)
-            except ValueError:
-                pass
+            if c.conn in self.networkManager.connections:
+                self.networkManager.removeConnection(c.conn)
+            c.conn.close()
+            self.readyPlayers.discard(c.conn)
             self.updateNumPlayers()  # Tell everyone they DC'd
         except AttributeError as e:
             print("Client probably sending stuff it shouldn't: " + str(e))
 
-        # Get the first 2 ready players
-        readyPlayers = self.readyPlayers[:2]
-
-        if len(readyPlayers) == 2:
-            if self.verbose:
-                print("Game time started. Forking subprocess.")
-            f = os.fork()
-            if f == 0:
-                random.seed()  # Regenerate the random seed for this game
-                netman = copy.copy(self.networkManager)
-                # We need only the players for the game we're currently serving
-                netman.connections = self.readyPlayers
-                GameServer(netman).run()
+    def acceptConnections(self, timeout=0):
+        self.guard(self.networkManager.recv, timeout)
+
+    def matchPlayers(self):
+        self.matchScheduled = False
+
+        readyPlayers = self.readyPlayers.nextPair()
+        while readyPlayers is not None:
+            if self.workerPool is not None:
+                self.workerPool.hostGame(readyPlayers)
+            elif self.hostsGames:
+                self.hostGame(readyPlayers)
             else:
-                self.networkManager.connections = [
-                    c for c in self.networkManager.connections
-                    if c not in readyPlayers]
-                self.gameServerProcs[f] = readyPlayers
-                # Remove the 2 players from the list of ready players
-                self.readyPlayers = self.readyPlayers[2:]
+                self.forkGame(readyPlayers)
+
+            readyPlayers = self.readyPlayers.nextPair()
+
+        if self.verbose and len(self.readyPlayers.waits) > 0:
+            print("Waits for a match: median %.2fs, p99 %.2fs" % (
+                self.readyPlayers.waitPercentile(50),
+                self.readyPlayers.waitPercentile(99)))
+        self.updateShard()
+
+    def hostGame(self, readyPlayers):
+        netman = self.networkManager.subManager(readyPlayers)
+        self.hostedGames.add(
+            GameServer(netman, onFinished=self.onHostedGameFinished))
 
+    def onHostedGameFinished(self, game, status):
+        """
+        Send the players that are still here back to the lobby
+        """
+        for pl in list(game.networkManager.connections):
+            self.networkManager.takeConnection(pl)
+
+        self.hostedGames.remove(game)
+        self.updateShard()
+
+    def onPlayersReturned(self, connections):
+        """
+        Called when a worker sends back the players from a finished game
+        """
+        if self.verbose:
+            print("Players back from game: " +
+                  str([c.addr for c in connections]))
+        self.updateShard()
+
+    def forkGame(self, readyPlayers):
+        if self.verbose:
+            print("Game time started. Forking subprocess.")
+        f = os.fork()
+        if f == 0:
+            random.seed()  # Regenerate the random seed for this game
+            # We need only the players for the game we're currently serving
+            netman = self.networkManager.split(readyPlayers)
+            GameServer(netman).run()
+        else:
+            for c in readyPlayers:
+                self.networkManager.removeConnection(c)
+            if len(self.gameServerProcs) == 0:
+                self.networkManager.callLater(
+                    self.reapInterval, self.reapGameServers)
+            self.gameServerProcs[f] = readyPlayers
+
+    def reapGameServers(self):
+        """
+        Clean up when game servers finish. Keeps checking until there are
+        no games left.
+        """
         while len(self.gameServerProcs) > 0:
-            # Clean up when the game server finishes
             pid = os.waitpid(-1, os.WNOHANG)[0]
             if pid != 0:
                 self.onGameServerFinished(pid)
             else:
                 break
 
+        if len(self.gameServerProcs) > 0:
+            self.networkManager.callLater(
+                self.reapInterval, self.reapGameServers)
+
     def onGameServerFinished(self, procid):
         """
         Send the player back to the lobby when the child proc finishes
         """
         for pl in self.gameServerProcs[procid]:
-            self.networkManager.connections.append(pl)
+            self.networkManager.addConnection(pl)
 
         self.gameServerProcs.pop(procid)
+        self.updateShard()
+
+    def run(self):
+        if isinstance(self.networkManager, AsyncNetworkManager):
+            asyncio.run(self.networkManager.serve())
+        else:
+            while 1:
+                # Sleep until a client does something or a timer is due
+                self.acceptConnections(timeout=None)
 
 
 if __name__ == "__main__":
-    lobby = LobbyServer(sys.argv)
-    while 1:
-        lobby.acceptConnections()
-        time.sleep(0.01)
+    if '--asyncio' in sys.argv:
+        for flag in ('--fork', '--workers', '--shards'):
+            if flag in sys.argv:
+                print(flag + " doesn't work with --asyncio.")
+                exit(1)
+
+    if '--shards' in sys.argv:
+        runShards(
+            int(sys.argv[sys.argv.index('--shards') + 1]),
+            lambda control: LobbyServer(sys.argv, shard=control))
+    else:
+        LobbyServer(sys.argv).run()
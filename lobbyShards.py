@@ -0,0 +1,201 @@
+"""
+Run the lobby as several processes (shards) that share its port with
+SO_REUSEPORT, so the kernel spreads players over them and their cores.
+
+A coordinator process links the shards. It adds up their player counts
+and sends them the total, at most every countInterval seconds. It also
+moves a waiting player from one shard to another so players on different
+shards can still be matched.
+
+Only works on Unix, since it passes sockets between processes.
+"""
+
+import os
+import random
+import socket
+
+from network_manager import NetworkManager, Connection
+from workerPool import sendConnections, recvConnections
+
+
+class ShardLink:
+    """
+    A shard's link to the coordinator. Used by LobbyServer.
+    """
+    def __init__(self, lobby, control):
+        self.lobby = lobby
+        self.control = control
+        # Players in the lobby on all the shards, as of the last update
+        self.total = 0
+        self.sentCount = None
+        # Whether we told the coordinator we have a player nobody here
+        # can play
+        self.waiting = False
+        lobby.networkManager.addReader(control, self.onMessage)
+
+    def send(self, info, connections=[]):
+        sendConnections(self.control, connections, info)
+
+    def reportCount(self, n):
+        if n != self.sentCount:
+            self.send(('count', n))
+            self.sentCount = n
+
+    def setWaiting(self, waiting):
+        if waiting != self.waiting:
+            self.send(('waiting', waiting))
+            self.waiting = waiting
+
+    def onMessage(self):
+        netman = self.lobby.networkManager
+        received = recvConnections(self.control, netman.connectionClass)
+        if received is None:
+            print("Lost the coordinator. Exiting.")
+            exit(1)
+
+        (kind, value), connections = received
+        if kind == 'total':
+            self.total = value
+            # It's already been held back by the coordinator
+            self.lobby.sendCounts()
+        elif kind == 'sendWaiting':
+            self.sendWaitingPlayer(value)
+        elif kind == 'player':
+            # A waiting player from another shard, to play one of ours
+            for conn in connections:
+                netman.addConnection(conn)
+                self.lobby.addPlayer(conn.addr)
+            self.lobby.updateNumPlayers()
+
+    def sendWaitingPlayer(self, shard):
+        """
+        Send our waiting player to shard, if we still have one.
+        """
+        readyPlayers = self.lobby.readyPlayers
+        self.waiting = False
+
+        if len(readyPlayers) == 1:
+            conn = readyPlayers.pop()
+            self.lobby.networkManager.removeConnection(conn)
+            self.send(('player', shard), [conn])
+            self.lobby.updateNumPlayers()
+        else:
+            self.send(('declined', shard))
+
+
+class Coordinator:
+    """
+    Runs in its own process and links the shards.
+    """
+    countInterval = 0.5
+
+    def __init__(self, controls):
+        self.networkManager = NetworkManager()
+        self.networkManager.sock.close()  # We don't have clients
+        # Each shard's control socket, or None if it died
+        self.controls = controls
+        self.counts = [0] * len(controls)
+        self.sentTotal = None
+        self.totalScheduled = False
+        # Shards that have a player nobody there can play
+        self.waiting = set()
+        # Shards we've asked to send a player to another shard, and the
+        # shards we asked them to send to
+        self.reserved = set()
+
+        for i, control in enumerate(controls):
+            self.networkManager.addReader(
+                control, lambda i=i: self.onMessage(i))
+
+    def send(self, shard, info, connections=[]):
+        if self.controls[shard] is None:
+            for c in connections:
+                c.close()
+        else:
+            sendConnections(self.controls[shard], connections, info)
+
+    def onMessage(self, shard):
+        received = recvConnections(self.controls[shard], Connection)
+        if received is None:
+            self.onShardDied(shard)
+            return
+
+        (kind, value), connections = received
+        if kind == 'count':
+            self.counts[shard] = value
+            self.scheduleTotal()
+        elif kind == 'waiting':
+            if value:
+                self.waiting.add(shard)
+            else:
+                self.waiting.discard(shard)
+            self.pairWaiting()
+        elif kind == 'player':
+            self.reserved -= {shard, value}
+            self.waiting.discard(shard)
+            self.send(value, ('player', None), connections)
+        elif kind == 'declined':
+            self.reserved -= {shard, value}
+            self.waiting.discard(shard)
+            self.pairWaiting()
+
+    def onShardDied(self, shard):
+        print("Lobby shard " + str(shard) + " died.")
+        self.networkManager.removeReader(self.controls[shard])
+        self.controls[shard].close()
+        self.controls[shard] = None
+        self.counts[shard] = 0
+        self.waiting.discard(shard)
+        self.scheduleTotal()
+
+    def pairWaiting(self):
+        """
+        Match up waiting players on different shards
+        """
+        shards = sorted(self.waiting - self.reserved)
+        while len(shards) >= 2:
+            src, dest = shards.pop(), shards.pop()
+            self.reserved |= {src, dest}
+            self.send(src, ('sendWaiting', dest))
+
+    def scheduleTotal(self):
+        if not self.totalScheduled:
+            self.networkManager.callLater(self.countInterval, self.sendTotal)
+            self.totalScheduled = True
+
+    def sendTotal(self):
+        self.totalScheduled = False
+        total = sum(self.counts)
+        if total != self.sentTotal:
+            for shard in range(len(self.controls)):
+                self.send(shard, ('total', total))
+            self.sentTotal = total
+
+    def run(self):
+        while any(c is not None for c in self.controls):
+            self.networkManager.recv(None)
+
+
+def runShards(n, makeShard):
+    """
+    Fork n shards, then be their coordinator.
+    makeShard is called in each shard with its control socket, and
+    returns something to run(), e.g. a LobbyServer.
+    """
+    controls = []
+    for i in range(n):
+        coordinatorSide, shardSide = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        if os.fork() == 0:
+            coordinatorSide.close()
+            for control in controls:
+                control.close()
+            random.seed()  # Regenerate the random seed for this shard
+            makeShard(shardSide).run()
+            os._exit(0)
+
+        shardSide.close()
+        controls.append(coordinatorSide)
+
+    Coordinator(controls).run()
@@ -0,0 +1,105 @@
+"""
+Queue of players waiting for a match. Adding, removing and pairing
+players all take constant time, however many are waiting.
+"""
+
+import collections
+import time
+
+
+class MatchQueue:
+    def __init__(self, key=None, waitSamples=1000):
+        """
+        key(player) picks who a player can be matched with. Only players
+        with the same key are paired, e.g. the same region or rating band.
+        By default everyone can play everyone, first come first served.
+        We remember how long the last waitSamples matched players waited.
+        """
+        self.key = key if key is not None else lambda player: None
+        # For each key, its players and when they joined, oldest first
+        self.buckets = {}
+        # Which bucket each player is in
+        self.players = {}
+        # Keys of the buckets with at least 2 players, oldest first
+        self.pairable = collections.OrderedDict()
+        self.waits = collections.deque(maxlen=waitSamples)
+
+    def __len__(self):
+        return len(self.players)
+
+    def __contains__(self, player):
+        return player in self.players
+
+    def __iter__(self):
+        return iter(self.players)
+
+    def add(self, player):
+        """
+        Put player at the back of the queue, unless they're already in it.
+        """
+        if player in self.players:
+            return
+
+        key = self.key(player)
+        bucket = self.buckets.setdefault(key, collections.OrderedDict())
+        bucket[player] = time.monotonic()
+        self.players[player] = key
+        if len(bucket) == 2:
+            self.pairable[key] = None
+
+    def discard(self, player):
+        """
+        Take player out of the queue if they're in it.
+        """
+        if player not in self.players:
+            return
+
+        key = self.players.pop(player)
+        bucket = self.buckets[key]
+        del bucket[player]
+        self.updateBucket(key, bucket)
+
+    def updateBucket(self, key, bucket):
+        if len(bucket) < 2:
+            self.pairable.pop(key, None)
+        if len(bucket) == 0:
+            del self.buckets[key]
+
+    def take(self, key):
+        """
+        Take the player who's waited longest from the bucket for key.
+        """
+        bucket = self.buckets[key]
+        player, joined = bucket.popitem(last=False)
+        del self.players[player]
+        self.updateBucket(key, bucket)
+        self.waits.append(time.monotonic() - joined)
+        return player
+
+    def pop(self):
+        """
+        Take someone out of the queue, e.g. to send to another lobby.
+        """
+        return self.take(next(iter(self.buckets)))
+
+    def nextPair(self):
+        """
+        Take the next 2 players that can play each other, or return None
+        if nobody can.
+        """
+        if len(self.pairable) == 0:
+            return None
+
+        key = next(iter(self.pairable))
+        return [self.take(key), self.take(key)]
+
+    def waitPercentile(self, p):
+        """
+        Get how long the pth percentile of recently matched players waited,
+        in seconds. None if nobody's been matched.
+        """
+        if len(self.waits) == 0:
+            return None
+
+        waits = sorted(self.waits)
+        return waits[min(len(waits) - 1, int(len(waits) * p / 100))]
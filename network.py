@@ -1,7 +1,11 @@
-import types
 import re
+import socket
+import struct
+import sys
+import inspect
 
-from network_manager import NetworkManager
+from network_manager import NetworkManager, Connection, binaryFrame
+from async_network_manager import AsyncNetworkManager, AsyncConnection
 from core.enums import numericEnum
 
 
@@ -20,26 +24,276 @@ def deserialize(packet):
             for s in re.findall('[a-z][^a-z]*', packet)]
 
 
-class ULNetworkManager(NetworkManager):
-    def tryCall(self, key, args):
-        if not hasattr(self.base, key):
-            raise OpcodeError("Opcode not found: " + key)
+class Features:
+    """
+    Bits for the protocol features a client asks for in negotiateProtocol
+    """
+    binary = 1
+    delta = 2
+    heartbeat = 4  # Answers ping with pong
+
+
+# Ops in an updateZone packet
+ZoneOp = numericEnum('insert', 'remove', 'move')
+
+
+# Binary packets are one item per arg, most of them a single byte: ints
+# from -32 to 127 are the byte itself and bools are a tag. Bigger ints and
+# floats are a tag followed by the value. The frame gives the length, so
+# there's no count.
+binaryFalse, binaryTrue = 0xc2, 0xc3
+binaryFloat, binaryInt8, binaryInt32, binaryInt64 = 0xcb, 0xd0, 0xd2, 0xd3
+binaryWide = {
+    binaryFloat: struct.Struct('>d'),
+    binaryInt8: struct.Struct('>b'),
+    binaryInt32: struct.Struct('>i'),
+    binaryInt64: struct.Struct('>q')}
+# What each single byte item decodes to, or None if it isn't one
+binaryValues = [i if i < 0x80 else i - 0x100 if i >= 0xe0 else None
+                for i in range(0x100)]
+binaryValues[binaryFalse], binaryValues[binaryTrue] = False, True
+binarySingles = bytes(
+    i for i, x in enumerate(binaryValues) if x is not None)
+
+
+def serializeBinary(args):
+    packet = bytearray()
+    for x in args:
+        if isinstance(x, bool):
+            packet.append(binaryTrue if x else binaryFalse)
+        elif isinstance(x, float):
+            packet.append(binaryFloat)
+            packet += binaryWide[binaryFloat].pack(x)
+        elif -0x20 <= x < 0x80:
+            packet.append(x & 0xff)
+        else:
+            if -0x80 <= x < 0x80:
+                tag = binaryInt8
+            elif -0x80000000 <= x < 0x80000000:
+                tag = binaryInt32
+            else:
+                tag = binaryInt64
+            packet.append(tag)
+            packet += binaryWide[tag].pack(x)
+    return bytes(packet)
+
+
+def deserializeBinary(packet):
+    if len(packet.translate(None, binarySingles)) == 0:
+        # Nothing but single bytes, which is most packets
+        return [binaryValues[b] for b in packet]
+
+    args = []
+    i = 0
+    while i < len(packet):
+        x = binaryValues[packet[i]]
+        if x is None:
+            s = binaryWide.get(packet[i])
+            if s is None:
+                raise ValueError("Bad tag: " + hex(packet[i]))
+            if i + 1 + s.size > len(packet):
+                raise ValueError("Packet ends partway through an arg")
+            x, = s.unpack_from(packet, i + 1)
+            i += s.size
+        args.append(x)
+        i += 1
+    return args
+
+
+def decode(packet):
+    """
+    Get the args from a text (str) or binary (bytes) packet
+    """
+    if isinstance(packet, str):
+        return deserialize(packet)
+    else:
+        return deserializeBinary(packet)
 
-        getattr(self.base, key)(*args)
 
-    def tryFindKey(self, opcode):
-        try:
-            return self.Opcodes.keys[opcode]
-        except IndexError:
+textOpcode = re.compile('i(-?[0-9]+)')
+
+
+def peekOpcode(packet):
+    """
+    Get the opcode of a packet without decoding the rest, or None if it
+    doesn't start with one.
+    """
+    try:
+        if isinstance(packet, str):
+            match = textOpcode.match(packet)
+            return None if match is None else int(match.group(1))
+
+        tag = packet[0]
+        if tag in (binaryInt8, binaryInt32, binaryInt64):
+            return binaryWide[tag].unpack_from(packet, 1)[0]
+        opcode = binaryValues[tag]
+        return opcode if type(opcode) is int else None
+    except (struct.error, IndexError):
+        return None
+
+
+def addOpcodeSenders(cls, opcodes, send):
+    """
+    Give cls a method for each of the opcodes that sends it by calling
+    send(self, [opcode, *args]). Done once per class, so making
+    connections doesn't have to make any functions.
+    """
+    def sender(opcode):
+        def fn(self, *args):
+            send(self, [opcode, *args])
+
+        fn.__name__ = opcodes.keys[opcode]
+        return fn
+
+    for i, key in enumerate(opcodes.keys):
+        setattr(cls, key, sender(i))
+
+
+def getArgCounts(func, skip=0):
+    """
+    Get the numbers of args func can be called with, not counting the
+    first skip of them.
+    """
+    try:
+        params = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):  # Can't tell, so let anything through
+        return range(0, sys.maxsize)
+
+    positional = [p for p in params if p.kind in (
+        p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)]
+    required = len([p for p in positional if p.default is p.empty]) - skip
+
+    if any(p.kind == p.VAR_POSITIONAL for p in params):
+        return range(required, sys.maxsize)
+    elif getattr(func, 'acceptsTarget', False):
+        # The target is sent as zone, index and whether it's the enemy's
+        return frozenset((required, required + 3))
+    else:
+        return range(required, len(positional) - skip + 1)
+
+
+class ULNetworkManager(NetworkManager):
+    # Opcodes that are about the connection itself, so we handle them
+    # instead of base
+    ownOpcodes = ()
+    # How many args onGotPacket passes to handlers before the operands
+    argsBefore = 0
+
+    @property
+    def base(self):
+        return self._base
+
+    @base.setter
+    def base(self, value):
+        self._base = value
+        # Look up the handlers once instead of for every packet
+        self.handlers = [self.findHandler(key) for key in self.Opcodes.keys]
+
+    def findHandler(self, key):
+        """
+        Get (key, handler, numbers of operands it takes), or None if
+        nobody handles key.
+        """
+        target = self if key in self.ownOpcodes else self.base
+        func = getattr(target, key, None)
+        if func is None:
+            return None
+
+        return (key, func, getArgCounts(func, self.argsBefore))
+
+    def callHandler(self, operands, *before):
+        """
+        Call the handler for the opcode in operands[0] with the rest of
+        them. Returns False without calling it if they're malformed.
+        """
+        if len(operands) == 0 or not all(
+                isinstance(x, int) for x in operands):
+            return False
+
+        opcode = operands[0]
+        if not 0 <= opcode < len(self.handlers):
             raise OpcodeError("Invalid index: " + str(opcode))
 
+        handler = self.handlers[opcode]
+        if handler is None:
+            # base might have got it since we looked
+            handler = self.handlers[opcode] = self.findHandler(
+                self.Opcodes.keys[opcode])
+            if handler is None:
+                raise OpcodeError(
+                    "Opcode not found: " + self.Opcodes.keys[opcode])
+
+        key, func, argCounts = handler
+        if len(operands) - 1 not in argCounts:
+            return False
+
+        if self.verbose:
+            print("got opcode ", key + " with args " + str(operands[1:]))
+
+        func(*before, *operands[1:])
+        return True
+
+    def sendOpcode(self, conn, args):
+        """
+        Send args in whichever format conn has agreed on
+        """
+        if conn.binary:
+            if self.verbose:
+                print("Sent binary packet " + str(args) + " to " +
+                      str(conn.addr))
+            conn.send(binaryFrame(serializeBinary(args)))
+        else:
+            self.sendTo(conn, serialize(args))
+
+
+class ClientOpcodes:
+    """
+    Mixin for connections on the server. Has a method for each client
+    opcode, which sends it through whichever manager is serving the
+    connection now, e.g. a game's rather than the lobby's.
+    """
+    pass
+
+
+class ServerConnection (ClientOpcodes, Connection):
+    pass
+
+
+class AsyncServerConnection (ClientOpcodes, AsyncConnection):
+    pass
+
 
 class ServerNetworkManager (ULNetworkManager):
-    def __init__(self, base):
+    def __init__(self, base, port=None, reusePort=False):
         super().__init__()
+        if port is not None:
+            self.port = port
+        if reusePort:
+            # Let other processes listen on the port too. The kernel
+            # spreads the connections over us
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.startServer()
         self.base = base
 
+    connectionClass = ServerConnection
+    ownOpcodes = ('negotiateProtocol', 'pong')
+    argsBefore = 1  # addr
+    supportedFeatures = Features.binary | Features.delta | Features.heartbeat
+
+    # Which rate limit each opcode comes under. The rest are moves in a
+    # game
+    opcodeRateKinds = {
+        'requestNumPlayers': 'query',
+        'addPlayer': 'lobby',
+        'negotiateProtocol': 'lobby',
+        'pong': 'heartbeat'}
+    rateLimits = {
+        'query': (2, 10),
+        'lobby': (1, 10),
+        'heartbeat': (1, 5),
+        'game': (30, 100),
+        'malformed': (1, 10)}
+
     Opcodes = numericEnum(
         'requestNumPlayers',
         'addPlayer',
@@ -52,44 +306,48 @@ class ServerNetworkManager (ULNetworkManager):
         'play',
         'endPhase',
         'replace',
-        'useThiefAbility')
+        'useThiefAbility',
+        'negotiateProtocol',
+        'pong')
 
     def onGotPacket(self, packet, addr):
         if packet == '':
             return
 
         try:
-            operands = deserialize(packet)
-        except KeyError:
-            print("Got malformed packet: " + packet)
+            operands = decode(packet)
+        except (KeyError, ValueError, struct.error):
+            print("Got malformed packet: " + repr(packet))
             return
 
-        (opcode, operands) = (operands[0], operands[1:])
+        if not self.callHandler(operands, addr):
+            print("Got malformed packet: " + repr(packet))
 
-        key = self.tryFindKey(opcode)
-
-        if self.verbose:
-            print("got opcode: ", key)
-
-        self.tryCall(key, [addr] + operands)
+    def rateKind(self, packet):
+        opcode = peekOpcode(packet)
+        if opcode is None or not 0 <= opcode < len(self.Opcodes.keys):
+            return 'malformed'
+        return self.opcodeRateKinds.get(self.Opcodes.keys[opcode], 'game')
 
     def onClientConnected(self, conn):
-        # Make it so each client opcode is a function
-        for i, key in enumerate(ClientNetworkManager.Opcodes.keys):
-            class OpcodeFunc:
-                def __init__(self, manager, opcode):
-                    self.manager = manager
-                    self.opcode = opcode
+        self.base.onClientConnected(conn)
 
-                def __call__(self, base, *args):
-                    self.manager.send(
-                        base.addr,
-                        serialize([self.opcode] + list(args)))
+    def negotiateProtocol(self, addr, features):
+        conn = self.connections.byAddr[addr]
+        conn.features = features & self.supportedFeatures
+        # Answer in text, since they can't read binary until they get this
+        conn.acceptProtocol(conn.features)
+        conn.binary = bool(conn.features & Features.binary)
 
-            # Bind the OpcodeFunc as a method to the class
-            setattr(conn, key, types.MethodType(OpcodeFunc(self, i), conn))
+    def probe(self, conn):
+        if conn.features & Features.heartbeat:
+            conn.ping()
+            return True
+        return False
 
-        self.base.onClientConnected(conn)
+    def pong(self, addr):
+        # Getting it was the point
+        pass
 
 
 class ClientNetworkManager (ULNetworkManager):
@@ -103,19 +361,21 @@ class ClientNetworkManager (ULNetworkManager):
         self.ip = ip
         self.port = port
 
-        # Make it so each server opcode is a function
-        for i, key in enumerate(ServerNetworkManager.Opcodes.keys):
-            class OpcodeFunc:
-                def __init__(self, opcode):
-                    self.opcode = opcode
+    ownOpcodes = ('acceptProtocol', 'ping')
+    # What we ask the server for when we connect
+    features = Features.binary | Features.delta | Features.heartbeat
 
-                def __call__(self, base, *args):
-                    base.send(
-                        (base.ip, base.port),
-                        serialize([self.opcode] + list(args)))
+    def onConnected(self):
+        if self.features:
+            self.negotiateProtocol(self.features)
 
-            # Bind the OpcodeFunc as a method to the class
-            setattr(self, key, types.MethodType(OpcodeFunc(i), self))
+    def acceptProtocol(self, features):
+        conn = self.connections[0]
+        conn.features = features
+        conn.binary = bool(features & Features.binary)
+
+    def ping(self):
+        self.pong()
 
     Opcodes = numericEnum(
         'onEnteredGame',
@@ -145,23 +405,45 @@ class ClientNetworkManager (ULNetworkManager):
         'winGame',
         'loseGame',
         'setActive',
-        'kick')
+        'kick',
+        'acceptProtocol',
+        'updateZone',
+        'ping')
 
     def onGotPacket(self, packet, addr):
         if packet == '':
             return
 
         try:
-            operands = deserialize(packet)
-        except KeyError:
-            print("Got malformed packet: " + packet)
+            operands = decode(packet)
+        except (KeyError, ValueError, struct.error):
+            print("Got malformed packet: " + repr(packet))
             return
 
-        (opcode, operands) = (operands[0], operands[1:])
+        if not self.callHandler(operands):
+            print("Got malformed packet: " + repr(packet))
 
-        key = self.tryFindKey(opcode)
 
-        if self.verbose:
-            print("got opcode ", key + " with args " + str(operands))
+# Make it so each opcode is a function
+addOpcodeSenders(
+    ClientOpcodes, ClientNetworkManager.Opcodes,
+    lambda conn, args: conn.manager.sendOpcode(conn, args))
+addOpcodeSenders(
+    ClientNetworkManager, ServerNetworkManager.Opcodes,
+    lambda netman, args: netman.sendOpcode(netman.connections[0], args))
+
 
-        self.tryCall(key, operands)
+class AsyncServerNetworkManager (ServerNetworkManager, AsyncNetworkManager):
+    """
+    ServerNetworkManager that runs on an asyncio event loop.
+    Call serve() from the loop to start accepting connections.
+    """
+    connectionClass = AsyncServerConnection
+
+
+class AsyncClientNetworkManager (ClientNetworkManager, AsyncNetworkManager):
+    """
+    ClientNetworkManager that runs on an asyncio event loop.
+    connect() is a coroutine.
+    """
+    pass
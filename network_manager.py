@@ -1,5 +1,11 @@
+import contextlib
+import copy
+import heapq
+import math
 import socket
-import select
+import selectors
+import struct
+import time
 
 
 class ConnectionClosed(BaseException):
@@ -7,20 +13,370 @@ class ConnectionClosed(BaseException):
         self.conn = conn
 
 
+# Binary packets start with this byte, then their length as a 16 bit int.
+# Text packets never start with it, so we can tell them apart.
+binaryMarker = 1
+binaryHeader = struct.Struct('>BH')
+
+
+class FrameTooLargeError(Exception):
+    pass
+
+
+def binaryFrame(payload):
+    return binaryHeader.pack(binaryMarker, len(payload)) + payload
+
+
 class Connection:
     def __init__(self, conn, addr):
         self.conn, self.addr = conn, addr
-        self.buffer = ''
+        # Bytes received but not handled yet. Everything before frameStart
+        # has been handled, and there's no terminator between frameStart
+        # and scanned.
+        self.buffer = bytearray()
+        self.frameStart = 0
+        self.scanned = 0
+        # Protocol features agreed on with the other end. See network.py
+        self.features = 0
+        # Whether we send packets in binary
+        self.binary = False
+        # Packets waiting to be sent together. None if we're not batching
+        self.batch = None
+        # Bytes the socket wouldn't take yet. Sent when it's writable
+        self.outbox = bytearray()
+        # Whether we've stopped reading until the other end catches up
+        self.readPaused = False
+        # How much we ask the socket for. 0 until the manager picks
+        self.readSize = 0
+        # When we last heard from them, and whether we've asked them to say
+        # something since. Only kept up if the manager drops idle ones
+        self.lastActive = 0
+        self.probed = False
+        # Our socket's file descriptor, while we're in a ConnectionRegistry
+        self.fd = None
+        # TokenBuckets for the kinds of packets they send, made as needed
+        self.buckets = {}
+        # The NetworkManager that handles our packets
+        self.manager = None
+
+    def send(self, packet):
+        if self.batch is not None:
+            self.batch += packet
+        else:
+            self.write(packet)
+
+    def write(self, packet):
+        """
+        Send what the socket will take now and queue the rest.
+        Never blocks.
+        """
+        if len(self.outbox) == 0:
+            try:
+                sent = self.conn.send(packet)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                # It's closed. recv will find out and clean up
+                return
+
+            if sent == len(packet):
+                return
+            packet = packet[sent:]
+
+        self.outbox += packet
+        self.manager.onWriteBlocked(self)
+
+    def flush(self):
+        """
+        Send as much of the outbox as the socket will take.
+        """
+        try:
+            sent = self.conn.send(self.outbox)
+        except BlockingIOError:
+            return
+        except OSError:
+            raise ConnectionClosed(self)
+
+        del self.outbox[:sent]
+
+    @contextlib.contextmanager
+    def batched(self):
+        """
+        Send all the packets sent inside the with block in one write
+        """
+        if self.batch is not None:  # Already batching
+            yield
+            return
+
+        self.batch = bytearray()
+        try:
+            yield
+        finally:
+            batch, self.batch = self.batch, None
+            if len(batch) > 0:
+                self.write(batch)
+
+    def nextFrame(self, maxFrameSize):
+        """
+        Get the next complete packet in the buffer, or None if there isn't
+        one yet. Text packets are returned as str, binary ones as bytes.
+        """
+        if (self.frameStart < len(self.buffer) and
+                self.buffer[self.frameStart] == binaryMarker):
+            frame = self.nextBinaryFrame(maxFrameSize)
+        else:
+            frame = self.nextTextFrame(maxFrameSize)
+
+        if frame is None:
+            # Throw away what we've handled so the buffer doesn't grow
+            del self.buffer[:self.frameStart]
+            self.scanned -= self.frameStart
+            self.frameStart = 0
+
+        return frame
+
+    def nextTextFrame(self, maxFrameSize):
+        """
+        Only looks at bytes it hasn't looked at before.
+        """
+        end = self.buffer.find(b'\0', self.scanned)
+
+        if end == -1:
+            self.scanned = len(self.buffer)
+            if self.scanned - self.frameStart > maxFrameSize:
+                raise FrameTooLargeError(
+                    "No packet terminator in %d bytes" %
+                    (self.scanned - self.frameStart))
+            return None
+
+        start = self.frameStart
+        self.frameStart = self.scanned = end + 1
+
+        with memoryview(self.buffer) as view:
+            return str(view[start:end], 'utf-8', 'replace')
+
+    def nextBinaryFrame(self, maxFrameSize):
+        start = self.frameStart + binaryHeader.size
+        if len(self.buffer) < start:
+            return None
+
+        marker, length = binaryHeader.unpack_from(self.buffer, self.frameStart)
+        if length > maxFrameSize:
+            raise FrameTooLargeError("Packet of %d bytes" % length)
+
+        end = start + length
+        if len(self.buffer) < end:
+            return None
+
+        self.frameStart = self.scanned = end
+
+        with memoryview(self.buffer) as view:
+            return bytes(view[start:end])
+
+    def fileno(self):
+        return self.conn.fileno()
 
     def close(self):
         self.conn.close()
 
+    def abort(self):
+        """
+        Cut the connection off. recv then handles it like any other
+        closed connection.
+        """
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class ConnectionRegistry:
+    """
+    A manager's connections, in the order they were added, indexed by
+    address and by file descriptor so finding one doesn't mean searching.
+    """
+    def __init__(self):
+        self.byAddr = {}
+        self.byFd = {}
+
+    def __len__(self):
+        return len(self.byAddr)
+
+    def __iter__(self):
+        return iter(self.byAddr.values())
+
+    def __contains__(self, conn):
+        return self.byAddr.get(conn.addr) is conn
+
+    def __getitem__(self, i):
+        """
+        Get the ith connection. Only for managers with a few, like a
+        game's or a client's.
+        """
+        return list(self.byAddr.values())[i]
+
+    def append(self, conn):
+        old = self.byAddr.get(conn.addr)
+        if old is not None:
+            # Something else had its address, so it must be long gone
+            self.remove(old)
+
+        self.byAddr[conn.addr] = conn
+        conn.fd = conn.fileno()
+        self.byFd[conn.fd] = conn
+
+    def remove(self, conn):
+        if conn not in self:
+            raise ValueError(str(conn.addr) + " isn't registered")
+
+        del self.byAddr[conn.addr]
+        # Its fd might have been reused by a connection added since
+        if self.byFd.get(conn.fd) is conn:
+            del self.byFd[conn.fd]
+        conn.fd = None
+
+
+class Timer:
+    def __init__(self, deadline, callback):
+        self.deadline, self.callback = deadline, callback
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel. Deadlines are rounded up to a whole tick, and each
+    tick only looks at one slot, so adding, removing and expiring items
+    takes O(1) time however many there are.
+    """
+    def __init__(self, tickLength=1, size=64):
+        self.tickLength = tickLength
+        # Each slot maps its items to their deadlines, in ticks
+        self.slots = [{} for i in range(size)]
+        self.slotOf = {}
+        self.current = math.floor(time.monotonic() / tickLength)
+        # Whether something will call advance()
+        self.scheduled = False
+
+    def __len__(self):
+        return len(self.slotOf)
+
+    def add(self, item, deadline):
+        """
+        Add item, or move it if it's already in. deadline is a
+        time.monotonic() time.
+        """
+        self.discard(item)
+        tick = max(math.ceil(deadline / self.tickLength), self.current + 1)
+        slot = self.slots[tick % len(self.slots)]
+        slot[item] = tick
+        self.slotOf[item] = slot
+
+    def discard(self, item):
+        slot = self.slotOf.pop(item, None)
+        if slot is not None:
+            del slot[item]
+
+    def advance(self, now):
+        """
+        Take out and return the items whose deadlines are up.
+        """
+        target = math.floor(now / self.tickLength)
+        # If we're a whole turn behind, every slot is due
+        ticks = min(target - self.current, len(self.slots))
+        expired = []
+
+        for i in range(self.current + 1, self.current + 1 + ticks):
+            slot = self.slots[i % len(self.slots)]
+            for item, tick in list(slot.items()):
+                # Items further ahead are still here next time round
+                if tick <= target:
+                    del slot[item]
+                    del self.slotOf[item]
+                    expired.append(item)
+
+        self.current = max(self.current, target)
+        return expired
+
+
+class TokenBucket:
+    """
+    Lets through rate things per second on average, and up to burst at
+    once after a quiet spell.
+    """
+    def __init__(self, rate, burst):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # How many things were turned away since the bucket was last full
+        self.refused = 0
+
+    def take(self, now):
+        """
+        Return whether one more thing is allowed at time now.
+        """
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= self.burst:
+            self.refused = 0
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+
+        self.refused += 1
+        return False
+
 
 class NetworkManager:
+    # What accept() wraps new sockets in
+    connectionClass = Connection
+    # (packets per second, burst) for each kind of packet from rateKind().
+    # Packets over the limit are dropped. Kinds that aren't here aren't
+    # limited
+    rateLimits = {}
+    # Drop connections that keep sending after this many of their packets
+    # were dropped
+    maxRefused = 100
+
     def __init__(self):
         self.ip = "127.0.0.1"
         self.port = 9099
+        # How much to read from a socket at once. Each connection's read
+        # size starts at bufsize and doubles up to maxBufsize while reads
+        # fill it, and halves again when they're mostly empty
         self.bufsize = 1024
+        self.maxBufsize = 64 * 1024
+        # Keep reading a ready socket until it's empty or we've read this
+        # much, so one busy client can't hold up the rest
+        self.readBudget = 256 * 1024
+        # Drop clients that send more than this without ending a packet
+        self.maxFrameSize = 64 * 1024
+        # Whether batched() groups packets into one write
+        self.batchSends = True
+        # Stop reading from a client once this much is waiting to be sent
+        # to it, and start again when it gets down to lowWaterMark
+        self.highWaterMark = 64 * 1024
+        self.lowWaterMark = 16 * 1024
+        # Drop clients that fall this far behind
+        self.maxOutbox = 1024 * 1024
+        # Socket options, set by tuneSocket. Our packets are small and
+        # something's usually waiting on each one, so don't hold them back
+        # to fill up segments. batched() already groups the ones that go
+        # together
+        self.noDelay = True
+        # (idle seconds, seconds between probes, probes) before the kernel
+        # gives up on a silent peer, or None to not check
+        self.keepAlive = (60, 10, 6)
+        # Kernel socket buffer sizes in bytes, or None to leave them be
+        self.sendBufferSize = None
+        self.recvBufferSize = None
 
         # internet, tcp
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -29,76 +385,440 @@ class NetworkManager:
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         # Use non blocking socket
         self.sock.setblocking(0)
-        self.connections = []
+        # Uses epoll on Linux. Each socket is registered once, with its
+        # Connection as the key data, so we never have to search for it.
+        self.selector = selectors.DefaultSelector()
+        self.connections = ConnectionRegistry()
+        self.timers = []  # heap of Timers, soonest first
         self.isClient = False
+        # Drop connections that go this many seconds without sending us
+        # anything. If they can, they're asked to say something first,
+        # and get probeTimeout seconds more to do it. None means never.
+        self.idleTimeout = None
+        self.probeTimeout = 10
+        # Whether to drop idle connections that can't be asked to say
+        # something. Off by default, since the player may just be thinking
+        # or waiting for a match. TCP keepalive notices if they're gone.
+        self.reapUnprobeable = False
+        self.idleWheel = TimerWheel()
 
         self.verbose = False
 
     def startServer(self):
+        self.tuneSocket(self.sock)
         self.sock.bind(("", self.port))
         self.sock.listen(2)
+        self.addReader(self.sock, self.accept)
+
+    def tuneSocket(self, sock):
+        """
+        Set our socket options on sock. Buffer sizes have to be set before
+        connecting or listening to get the most out of them.
+        """
+        sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.noDelay))
+
+        if self.keepAlive is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Not every platform lets us set the timing
+            idle, interval, count = self.keepAlive
+            for option, value in (('TCP_KEEPIDLE', idle),
+                                  ('TCP_KEEPINTVL', interval),
+                                  ('TCP_KEEPCNT', count)):
+                if hasattr(socket, option):
+                    sock.setsockopt(
+                        socket.IPPROTO_TCP, getattr(socket, option), value)
+
+        if self.sendBufferSize is not None:
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, self.sendBufferSize)
+        if self.recvBufferSize is not None:
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, self.recvBufferSize)
+
+    def addReader(self, sock, callback):
+        """
+        Have recv call callback when sock is readable. For sockets that
+        aren't clients, like the listening socket.
+        """
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+    def removeReader(self, sock):
+        self.selector.unregister(sock)
+
+    def addConnection(self, conn):
+        conn.manager = self
+        self.connections.append(conn)
+        self.selector.register(conn.conn, self.getEvents(conn), conn)
+        self.watchIdle(conn)
+
+    def getEvents(self, conn):
+        """
+        Get what to wait for on conn's socket
+        """
+        events = 0 if conn.readPaused else selectors.EVENT_READ
+        if len(conn.outbox) > 0:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def updateEvents(self, conn):
+        try:
+            self.selector.modify(conn.conn, self.getEvents(conn), conn)
+        except KeyError:  # Not one of ours any more
+            pass
+
+    def onWriteBlocked(self, conn):
+        """
+        Called when conn couldn't send everything right away.
+        """
+        if len(conn.outbox) > self.maxOutbox:
+            if self.verbose:
+                print("Dropping " + str(conn.addr) + " for falling behind")
+            conn.abort()
+        elif len(conn.outbox) > self.highWaterMark:
+            conn.readPaused = True
+
+        self.updateEvents(conn)
+
+    def removeConnection(self, conn):
+        self.connections.remove(conn)
+        self.selector.unregister(conn.conn)
+        self.idleWheel.discard(conn)
+
+    def setConnections(self, connections):
+        """
+        Replace our connections with the given ones.
+        Gets a new selector, so after a fork this doesn't touch the
+        epoll set we share with the parent.
+        """
+        self.selector = selectors.DefaultSelector()
+        self.connections = ConnectionRegistry()
+        for conn in connections:
+            self.addConnection(conn)
+
+    def split(self, connections):
+        """
+        Make a copy of this manager that only serves the given connections.
+        The copy has its own selector and timers, so it can run by itself
+        after a fork.
+        """
+        netman = copy.copy(self)
+        netman.timers = []
+        netman.idleWheel = TimerWheel(
+            self.idleWheel.tickLength, len(self.idleWheel.slots))
+        netman.setConnections(connections)
+        return netman
+
+    def subManager(self, connections):
+        """
+        Make a copy of this manager that handles the packets from the given
+        connections. They stay on our selector and timers, and recv passes
+        their packets on to the copy. They're taken out of our connections
+        until we get them back with takeConnection.
+        """
+        netman = copy.copy(self)
+        netman.connections = ConnectionRegistry()
+        for conn in connections:
+            netman.takeConnection(conn)
+        return netman
+
+    def takeConnection(self, conn):
+        """
+        Take conn from the manager sharing our loop that has it now.
+        """
+        conn.manager.connections.remove(conn)
+        conn.manager = self
+        self.connections.append(conn)
+
+    def watchIdle(self, conn):
+        """
+        Start timing how long conn has been quiet, if we drop idle
+        connections.
+        """
+        if self.idleTimeout is None:
+            return
+
+        conn.lastActive = time.monotonic()
+        conn.probed = False
+        self.idleWheel.add(conn, conn.lastActive + self.idleTimeout)
+        if not self.idleWheel.scheduled:
+            self.callLater(self.idleWheel.tickLength, self.checkIdle)
+            self.idleWheel.scheduled = True
+
+    def checkIdle(self):
+        """
+        Probe or drop the connections that have been quiet too long.
+        Runs every tick of the idle wheel while there are connections.
+        """
+        now = time.monotonic()
+        for conn in self.idleWheel.advance(now):
+            if now - conn.lastActive < self.idleTimeout:
+                # They've said something since we checked
+                conn.probed = False
+                self.idleWheel.add(conn, conn.lastActive + self.idleTimeout)
+            elif not conn.probed and conn.manager.probe(conn):
+                conn.probed = True
+                self.idleWheel.add(conn, now + self.probeTimeout)
+            elif not conn.probed and not conn.manager.reapUnprobeable:
+                self.idleWheel.add(conn, now + self.idleTimeout)
+            else:
+                if self.verbose:
+                    print("Dropping " + str(conn.addr) + " for being idle")
+                self.dispatch(conn.manager, conn.manager.reap, conn)
+
+        if len(self.idleWheel) > 0:
+            self.callLater(self.idleWheel.tickLength, self.checkIdle)
+        else:
+            self.idleWheel.scheduled = False
+
+    def probe(self, conn):
+        """
+        Ask conn to send us something. Returns whether it can.
+        Override this
+        """
+        return False
+
+    def reap(self, conn):
+        """
+        Drop conn, e.g. for being idle. Cleaned up like any other closed
+        one. The socket is cut off but left open, since whoever handles
+        ConnectionClosed may still send to it, and closes it after.
+        """
+        self.removeConnection(conn)
+        conn.abort()
+        raise ConnectionClosed(conn)
+
+    def callLater(self, delay, callback):
+        """
+        Call callback after delay seconds. It is run by recv, which won't
+        wait past the deadline of the next timer.
+        """
+        timer = Timer(time.monotonic() + delay, callback)
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def runTimers(self):
+        now = time.monotonic()
+        while len(self.timers) > 0 and self.timers[0].deadline <= now:
+            timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                timer.callback()
+
+    def getTimeout(self, timeout):
+        """
+        Get how long we can wait for sockets before a timer is due.
+        None means forever.
+        """
+        while len(self.timers) > 0 and self.timers[0].cancelled:
+            heapq.heappop(self.timers)
+
+        if len(self.timers) == 0:
+            return timeout
+
+        untilTimer = max(0, self.timers[0].deadline - time.monotonic())
+        return untilTimer if timeout is None else min(timeout, untilTimer)
 
     def accept(self):
         """
         Accept connections. Does not block
         """
-        readers, writers, errors = select.select([self.sock], [], [], 0)
-        if len(readers) > 0:
+        try:
             # Get connection
-            conn = Connection(*self.sock.accept())
-            self.connections.append(conn)
-            self.onClientConnected(conn)  # Do callback
+            sock, addr = self.sock.accept()
+        except BlockingIOError:
+            return
+
+        self.tuneSocket(sock)
+        conn = self.connectionClass(sock, addr)
+        self.addConnection(conn)
+        self.onClientConnected(conn)  # Do callback
 
     def close(self):
         for conn in self.connections:
             conn.close()
 
     def connect(self, addr):
+        self.tuneSocket(self.sock)
         self.sock.setblocking(1)
         self.sock.connect(addr)
-        self.connections = [Connection(self.sock, addr)]
+        self.setConnections([Connection(self.sock, addr)])
         self.isClient = True
         self.sock.setblocking(0)
+        self.onConnected()
 
     def send(self, target, data):
+        if self.isClient:
+            tgt = self.connections[0]
+        else:
+            tgt = self.connections.byAddr[target]
+
+        self.sendTo(tgt, data)
+
+    def sendTo(self, conn, data):
         packet = bytes(str(data) + '\0', 'utf-8')
 
         if self.verbose:
-            print("Sent packet " + str(packet) + " to " + str(target))
+            print("Sent packet " + str(packet) + " to " + str(conn.addr))
 
-        if self.isClient:
-            self.sock.sendall(packet)
+        conn.send(packet)
+
+    def batched(self, conn):
+        """
+        Send everything sent to conn inside the with block in one write
+        """
+        if self.batchSends:
+            return conn.batched()
         else:
-            tgt = next(x for x in self.connections if x.addr == target)
-            tgt.conn.sendall(packet)
+            return contextlib.nullcontext()
 
     def sendInts(self, target, *args):
         self.send(target, ":".join(str(x) for x in args))
 
-    def recv(self):
-        readers, writers, errors = select.select(
-            [c.conn for c in self.connections], [], [], 0)
+    def recv(self, timeout=0):
+        """
+        Accept new connections and read from the sockets that are ready.
+        Only touches sockets that have something for us.
+        Waits up to timeout seconds for one to be ready (forever if None),
+        but not past the next timer, then runs the timers that are due.
+        """
+        for key, events in self.selector.select(self.getTimeout(timeout)):
+            c = key.data
+
+            if not isinstance(c, Connection):
+                c()  # Registered with addReader
+                continue
 
-        for conn in readers:
-            c = next(x for x in self.connections if x.conn == conn)
+            if c not in c.manager.connections:
+                # Dropped or handed off earlier in this batch
+                continue
 
+            if c.manager is self:
+                self.handleEvents(c, events)
+            else:
+                # It's in a game we're hosting
+                self.dispatch(c.manager, self.handleEvents, c, events)
+
+        self.runTimers()
+
+    def handleEvents(self, c, events):
+        """
+        Write to and read from c, depending on what it's ready for.
+        Raises ConnectionClosed if it's closed.
+        """
+        if events & selectors.EVENT_WRITE:
+            self.flush(c)
+
+        if not events & selectors.EVENT_READ:
+            return
+
+        budget = self.readBudget
+        while budget > 0:
+            size = c.readSize or self.bufsize
             try:
-                newData = c.conn.recv(self.bufsize).decode()
+                newData = c.conn.recv(size)
+            except BlockingIOError:  # Drained it
+                return
             except ConnectionResetError:
                 raise ConnectionClosed(c)
 
-            if newData == "":
+            if newData == b"":
                 raise ConnectionClosed(c)
 
-            c.buffer += newData
-            data = c.buffer.split('\0')
-            c.buffer = data[-1]
-            data = data[:-1]
+            budget -= len(newData)
+            if len(newData) == size:
+                c.readSize = min(size * 2, self.maxBufsize)
+            elif len(newData) < size // 4:
+                c.readSize = max(size // 2, self.bufsize)
 
-            tgt = next(x for x in self.connections if x.conn == conn)
+            c.manager.onGotData(c, newData)
 
-            for d in data:
-                self.onGotPacket(d, tgt.addr)
+            # A short read means it's empty, so don't ask again. Also stop
+            # if it's been paused or handed off
+            if (len(newData) < size or c.readPaused or
+                    c not in c.manager.connections):
+                return
+
+    def dispatch(self, manager, func, *args):
+        """
+        Call func inside the error handling of whatever is using manager's
+        connections, the way its own loop would call recv.
+        """
+        if hasattr(manager.base, 'guard'):
+            manager.base.guard(func, *args)
+        else:
+            try:
+                func(*args)
+            except ConnectionClosed as c:
+                # Nothing else to clean up
+                if c.conn in manager.connections:
+                    manager.removeConnection(c.conn)
+                c.conn.close()
+
+    def flush(self, c):
+        """
+        Send what's waiting in c's outbox, and start reading from it again
+        if it's caught up.
+        """
+        c.flush()
+
+        if c.readPaused and len(c.outbox) <= self.lowWaterMark:
+            c.readPaused = False
+
+        self.updateEvents(c)
+
+    def onGotData(self, c, newData):
+        """
+        Add newData to c's buffer and handle the packets it completes.
+        """
+        c.buffer += newData
+        if self.idleTimeout is not None:
+            c.lastActive = time.monotonic()
+
+        while True:
+            try:
+                packet = c.nextFrame(self.maxFrameSize)
+            except FrameTooLargeError as e:
+                if self.verbose:
+                    print(str(e) + " from " + str(c.addr))
+                # Whoever handles this closes it when they're done with it
+                raise ConnectionClosed(c)
+
+            if packet is None:
+                break
+
+            if self.allowPacket(c, packet):
+                self.onGotPacket(packet, c.addr)
+
+    def rateKind(self, packet):
+        """
+        Get which of rateLimits applies to packet. Override this
+        """
+        return 'packet'
+
+    def allowPacket(self, c, packet):
+        """
+        Check packet against c's rate limits. Drops c if it's flooding us.
+        """
+        if len(self.rateLimits) == 0:
+            return True
+
+        kind = self.rateKind(packet)
+        if kind not in self.rateLimits:
+            return True
+
+        bucket = c.buckets.get(kind)
+        if bucket is None:
+            bucket = c.buckets[kind] = TokenBucket(*self.rateLimits[kind])
+        if bucket.take(time.monotonic()):
+            return True
+
+        if bucket.refused > self.maxRefused:
+            if self.verbose:
+                print("Dropping " + str(c.addr) + " for flooding")
+            self.reap(c)
+        elif self.verbose:
+            print("Throttling " + str(c.addr))
+        return False
 
     def onClientConnected(self, conn):
         """
@@ -106,5 +826,11 @@ class NetworkManager:
         """
         print(conn)
 
+    def onConnected(self):
+        """
+        Callback for when we've connected to the server
+        """
+        pass
+
     def onGotPacket(self, packet, addr):
         print(packet)
@@ -8,3 +8,19 @@ def test_card_dsl():
     assert not hasattr(Bar, 'a')
     bar = Bar()
     assert bar.a == 'Moo'
+
+
+def test_card_dsl_shares_class_data():
+    class Baz(Card):
+        name = "Baz"
+        rank = 's'
+
+    baz, baz2 = Baz(), Baz()
+    assert 'name' not in vars(baz)
+    assert baz.name == "Baz" and baz.spell and baz.cost == 0
+    assert not hasattr(Baz, 'spell')
+
+    # Cards can still change their own
+    baz.rank = 3
+    assert not baz.spell and baz.rank == 3
+    assert baz2.spell and baz2.rank == 's'
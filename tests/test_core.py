@@ -4,6 +4,8 @@ import core.player
 from core.player import Player, IllegalMoveError
 from factions.templars import Templar
 import factions.base
+from core.faction import deck
+from core.zone import FaceupZone
 
 
 def deckContainsDuplicates(deck):
@@ -28,6 +30,15 @@ def testForDuplicatesBetweenPlayers():
             assert card1 != card2
 
 
+def testDeckSpec():
+    spec = deck(dummyCards.one, 2, dummyCards.one) + factions.base.deck
+    assert len(spec) == 6
+    cards = spec.build()
+    assert [c.name for c in cards] == [c.name for c in spec]
+    assert not set(map(id, cards)) & set(map(id, spec.build()))
+    assert spec[0] is spec.prototypes[0]
+
+
 def testReveal():
     game, player, p1 = util.newGame(dummyCards.one())
     player.endPhase()  # draw the card
@@ -168,3 +179,75 @@ def testZoneLists():
 
     for z in p0.zones:
         assert z not in p1.zones
+
+
+def testEventTriggerOrder():
+    calls = []
+
+    class listener(dummyCards.one):
+        def afterEndTurn(self):
+            calls.append(self)
+            if self.faceup:
+                for c in self.controller.faceups[:]:
+                    if c is not self:
+                        c.zone = c.owner.graveyard
+
+    game, p0, p1 = util.newGame(
+        [listener(), dummyCards.one(), listener()],
+        [dummyCards.one(), listener()])
+    for pl in (p0, p1):
+        for c in pl.deck[:]:
+            c.zone = pl.faceups
+    first, second = [c for c in p0.faceups if isinstance(c, listener)]
+    third, = [c for c in p1.faceups if isinstance(c, listener)]
+
+    # Cards that leave partway through still get the event
+    game.doEventTriggers('afterEndTurn')
+    assert calls == [first, second, third]
+    assert list(p0.faceups) == [first]
+    assert list(p1.faceups) == [third]
+
+    calls.clear()
+    game.doEventTriggers('afterEndTurn')
+    assert calls == [first, third]
+    assert p0.faceups.listeners('afterEndTurn') == [first]
+    assert p0.faceups.listeners('afterDestroy') == []
+
+
+def testTriggerListsFollowZone():
+    class listener(dummyCards.one):
+        def afterEndTurn(self):
+            pass
+
+    game, p0, p1 = util.newGame(
+        [listener(), dummyCards.one(), listener(), listener()])
+    a, b, c, d = p0.deck
+    zone = FaceupZone(p0, [a, b])
+
+    def listeners():
+        return zone.listeners('afterEndTurn')
+
+    assert listeners() == [a]
+    zone.extend([c])
+    assert listeners() == [a, c]
+    zone.reverse()
+    assert listeners() == [c, a]
+    zone.sort(key=lambda x: x is not a)
+    assert listeners() == [a, c]
+    zone += [d]
+    assert listeners() == [a, c, d]
+    zone.clear()
+    assert listeners() == []
+
+
+def testControllerFollowsZone():
+    game, p0, p1 = util.newGame(dummyCards.one())
+    card = p0.deck[0]
+    for zone in p0.zones[1:]:
+        assert zone.controller is p0
+
+    card.zone = p1.faceups  # e.g. stolen
+    assert card.controller is p1
+    assert card.owner is p0
+    card.zone = card.owner.graveyard
+    assert card.controller is p0
@@ -0,0 +1,44 @@
+from matchmaking import MatchQueue
+
+
+def testFirstComeFirstServed():
+    q = MatchQueue()
+    for player in 'abcde':
+        q.add(player)
+    q.add('a')  # Already waiting
+    q.discard('b')
+    q.discard('z')
+
+    assert len(q) == 4
+    assert q.nextPair() == ['a', 'c']
+    assert q.nextPair() == ['d', 'e']
+    assert q.nextPair() is None
+    assert len(q) == 0
+
+
+def testKey():
+    q = MatchQueue(key=lambda player: player[0])
+    for player in ['x1', 'y1', 'x2', 'y2', 'x3']:
+        q.add(player)
+
+    assert q.nextPair() == ['x1', 'x2']
+    assert q.nextPair() == ['y1', 'y2']
+    assert q.nextPair() is None
+    assert 'x3' in q
+
+    q.discard('x3')
+    assert len(q) == 0
+    assert q.buckets == {}
+
+
+def testWaitPercentile():
+    q = MatchQueue()
+    assert q.waitPercentile(50) is None
+
+    for player in range(4):
+        q.add(player)
+    while q.nextPair() is not None:
+        pass
+
+    assert len(q.waits) == 4
+    assert 0 <= q.waitPercentile(50) <= q.waitPercentile(99)
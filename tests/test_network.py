@@ -0,0 +1,841 @@
+import asyncio
+import builtins
+import selectors
+import socket
+import sys
+import time
+import types
+
+import network
+from network_manager import (
+    NetworkManager, Connection, ConnectionClosed, ConnectionRegistry,
+    FrameTooLargeError, TimerWheel, TokenBucket, binaryFrame)
+from lobbyServer import LobbyServer
+from gameServer import zoneDiff
+from lobbyShards import Coordinator
+from . import dummyCards, util
+from workerPool import GameWorker, sendConnections, recvConnections
+
+
+class RecordingClient:
+    """
+    Client base that remembers which opcodes it got
+    """
+    def __init__(self):
+        self.received = []
+        for key in network.ClientNetworkManager.Opcodes.keys:
+            setattr(self, key, self.recorder(key))
+
+    def recorder(self, key):
+        return lambda *args: self.received.append((key, args))
+
+    def got(self, key):
+        return [args for k, args in self.received if k == key]
+
+
+def frames(conn, maxFrameSize=64):
+    result = []
+    packet = conn.nextFrame(maxFrameSize)
+    while packet is not None:
+        result.append(packet)
+        packet = conn.nextFrame(maxFrameSize)
+    return result
+
+
+def testFraming():
+    conn = Connection(None, None)
+    conn.buffer += b'i1\0i2b1\0i'
+    assert frames(conn) == ['i1', 'i2b1']
+    assert frames(conn) == []
+    conn.buffer += b'3'
+    assert frames(conn) == []
+    conn.buffer += b'\0\0'
+    assert frames(conn) == ['i3', '']
+    assert len(conn.buffer) == 0
+
+
+def testMaxFrameSize():
+    conn = Connection(None, None)
+    conn.buffer += b'i1' * 32
+    assert frames(conn) == []
+    conn.buffer += b'i1'
+    try:
+        frames(conn)
+    except FrameTooLargeError:
+        pass
+    else:
+        assert False
+
+
+def testBatchedSends():
+    class Sock:
+        writes = []
+
+        def send(self, data):
+            self.writes.append(bytes(data))
+            return len(data)
+
+    conn = Connection(Sock(), None)
+    with conn.batched():
+        conn.send(b'i1\0')
+        with conn.batched():
+            conn.send(b'i2\0')
+        assert Sock.writes == []
+    assert Sock.writes == [b'i1\0i2\0']
+
+
+def testBackpressure():
+    netman = NetworkManager()
+    netman.highWaterMark = 1024
+    netman.lowWaterMark = 0
+    netman.maxOutbox = 4 * 1024 * 1024
+    ours, theirs = socket.socketpair()
+    ours.setblocking(0)
+    conn = Connection(ours, 'client')
+    netman.addConnection(conn)
+
+    # More than the socket buffers can take
+    conn.send(b'x' * 2 * 1024 * 1024)
+    assert len(conn.outbox) > 0
+    assert conn.readPaused
+    assert netman.selector.get_key(ours).events == selectors.EVENT_WRITE
+
+    theirs.setblocking(0)
+    received = 0
+    while len(conn.outbox) > 0:
+        try:
+            received += len(theirs.recv(1024 * 1024))
+        except BlockingIOError:
+            pass
+        netman.recv(0.1)
+    assert received + len(theirs.recv(1024 * 1024)) == 2 * 1024 * 1024
+    assert not conn.readPaused
+    assert netman.selector.get_key(ours).events == selectors.EVENT_READ
+
+    # Falling too far behind gets you dropped
+    netman.maxOutbox = 1024
+    conn.send(b'x' * 2 * 1024 * 1024)
+    try:
+        netman.recv(1)
+    except ConnectionClosed as e:
+        assert e.conn is conn
+    else:
+        assert False
+
+
+def testReadsDrainSocket():
+    netman = NetworkManager()
+    netman.readBudget = 24 * 1024
+    packets = []
+    netman.onGotPacket = lambda packet, addr: packets.append(packet)
+    ours, theirs = socket.socketpair()
+    ours.setblocking(0)
+    conn = Connection(ours, 'client')
+    netman.addConnection(conn)
+
+    theirs.sendall((b'x' * 99 + b'\0') * 320)
+    netman.recv(1)
+    # Up to the budget, in fewer, bigger reads as it goes
+    assert 240 <= len(packets) < 320
+    assert conn.readSize > netman.bufsize
+
+    netman.recv(1)
+    assert len(packets) == 320
+
+    # Small reads shrink it again
+    for i in range(4):
+        theirs.sendall(b'x\0')
+        netman.recv(1)
+    assert conn.readSize == netman.bufsize
+
+    theirs.close()
+    ours.close()
+
+
+def testSocketOptions():
+    netman = NetworkManager()
+    netman.recvBufferSize = 32 * 1024
+    sock = socket.socket()
+    netman.tuneSocket(sock)
+    assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    # Linux doubles it for its own bookkeeping
+    assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 32 * 1024
+    sock.close()
+
+    netman.noDelay = False
+    netman.keepAlive = None
+    sock = socket.socket()
+    netman.tuneSocket(sock)
+    assert not sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    assert not sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+    sock.close()
+    netman.sock.close()
+
+
+def testConnectionRegistry():
+    registry = ConnectionRegistry()
+    socks = [socket.socket() for i in range(3)]
+    conns = [Connection(s, ('localhost', i)) for i, s in enumerate(socks)]
+    for conn in conns:
+        registry.append(conn)
+    registry.remove(conns[1])
+
+    assert list(registry) == [conns[0], conns[2]]
+    assert registry[1] is conns[2]
+    assert conns[1] not in registry
+    assert registry.byAddr[('localhost', 2)] is conns[2]
+    assert registry.byFd[socks[0].fileno()] is conns[0]
+    assert conns[1].fd is None
+
+    # Coming back after a game goes on the end
+    registry.append(conns[1])
+    assert list(registry) == [conns[0], conns[2], conns[1]]
+
+    # A new connection from an old one's address replaces it entirely
+    sock = socket.socket()
+    socks.append(sock)
+    newer = Connection(sock, ('localhost', 0))
+    registry.append(newer)
+    assert list(registry) == [conns[2], conns[1], newer]
+    assert conns[0] not in registry and conns[0].fd is None
+    assert socks[0].fileno() not in registry.byFd
+    assert registry.byFd[sock.fileno()] is newer
+
+    # Removing one whose fd has been reused leaves the new one alone
+    fd = conns[2].fd
+    registry.byFd[fd] = newer
+    registry.remove(conns[2])
+    assert registry.byFd[fd] is newer
+
+    for sock in socks:
+        sock.close()
+
+
+def testTimerWheel():
+    wheel = TimerWheel(tickLength=1, size=4)
+    now = wheel.current
+    wheel.add('a', now + 1)
+    wheel.add('b', now + 2)
+    wheel.add('c', now + 6)  # More than a turn of the wheel away
+    wheel.add('d', now + 2)
+    wheel.discard('d')
+
+    assert wheel.advance(now + 0.5) == []
+    assert wheel.advance(now + 1) == ['a']
+    assert wheel.advance(now + 3) == ['b']
+    assert wheel.advance(now + 5) == []
+    assert len(wheel) == 1
+    assert wheel.advance(now + 20) == ['c']
+    assert len(wheel) == 0
+
+
+def testTokenBucket():
+    bucket = TokenBucket(rate=2, burst=3)
+    now = bucket.updated
+    assert [bucket.take(now) for i in range(5)] == [
+        True, True, True, False, False]
+    assert bucket.refused == 2
+
+    assert bucket.take(now + 0.5)
+    assert not bucket.take(now + 0.5)
+    assert bucket.refused == 3
+
+    # Refusals are forgotten once it's had time to fill up
+    assert bucket.take(now + 10)
+    assert bucket.refused == 0
+    assert bucket.tokens == 2
+
+
+def testPeekOpcode():
+    for args in ([5], [3, -1, 2], [300, 1]):
+        assert network.peekOpcode(network.serialize(args)) == args[0]
+        assert network.peekOpcode(network.serializeBinary(args)) == args[0]
+
+    for args in ([], [2.5], [True]):
+        assert network.peekOpcode(network.serialize(args)) is None
+        assert network.peekOpcode(network.serializeBinary(args)) is None
+    assert network.peekOpcode(b'') is None
+    assert network.peekOpcode(b'\xd2\x00') is None
+
+
+def testTextRoundTrip():
+    args = [3, -1, 0, True, False, 120]
+    assert network.deserialize(network.serialize(args)) == args
+
+
+def testBinaryRoundTrip():
+    for args in ([], [0], [3, -1, True, False],
+                 [127, -32, -33, -128, 128, -129, 2 ** 31, -2 ** 31 - 1,
+                  2 ** 40],
+                 [2.5, -0.25],
+                 list(range(200))):
+        decoded = network.deserializeBinary(network.serializeBinary(args))
+        assert decoded == args
+        assert [type(x) for x in decoded] == [type(x) for x in args]
+
+
+def testMalformedBinary():
+    packet = network.serializeBinary([1, 200, 3])
+    # Cut off partway through the 200, and an unknown tag
+    for bad in (packet[:2], packet + b'\xc1'):
+        try:
+            network.deserializeBinary(bad)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+
+def testMixedFraming():
+    conn = Connection(None, None)
+    payload = network.serializeBinary([7, 0, -1])
+    conn.buffer += b'i1\0' + binaryFrame(payload) + b'i2\0'
+    assert frames(conn) == ['i1', payload, 'i2']
+
+    # Binary packets can arrive a byte at a time
+    for byte in binaryFrame(payload):
+        assert frames(conn) == []
+        conn.buffer.append(byte)
+    assert frames(conn) == [payload]
+
+
+async def waitFor(condition, timeout=2):
+    for i in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+def testDispatchChecksArgs():
+    class Base:
+        def __init__(self):
+            self.calls = []
+
+        def attack(self, addr, cardIndex, targetIndex, targetZone):
+            self.calls.append((cardIndex, targetIndex, targetZone))
+
+    base = Base()
+    netman = network.ServerNetworkManager(base, port=0)
+    attack = network.ServerNetworkManager.Opcodes.attack
+    netman.onGotPacket(network.serialize([attack, 1, 2]), 'addr')
+    netman.onGotPacket(network.serialize([attack, 1, 2, 3, 4]), 'addr')
+    netman.onGotPacket(binaryFrame(b'')[3:], 'addr')
+    assert base.calls == []
+
+    netman.onGotPacket(network.serialize([attack, 1, 2, 3]), 'addr')
+    netman.onGotPacket(network.serializeBinary([attack, 4, 5, 6]), 'addr')
+    assert base.calls == [(1, 2, 3), (4, 5, 6)]
+
+    try:
+        netman.onGotPacket(network.serialize([-1]), 'addr')
+    except network.OpcodeError:
+        pass
+    else:
+        assert False
+    netman.sock.close()
+
+
+def clientInstructions(game):
+    """
+    Make the Panda3D client's NetworkInstructions without Panda3D, with
+    the game's players as the client's player and enemy.
+    """
+    if 'client.networkInstructions' not in sys.modules:
+        showbase = types.ModuleType('direct.showbase.DirectObject')
+        showbase.DirectObject = object
+        sys.modules.setdefault('direct', types.ModuleType('direct'))
+        sys.modules.setdefault(
+            'direct.showbase', types.ModuleType('direct.showbase'))
+        sys.modules.setdefault('direct.showbase.DirectObject', showbase)
+    from client.networkInstructions import NetworkInstructions
+
+    builtins.base = types.SimpleNamespace(
+        game=game, player=game.players[0], enemy=game.players[1],
+        redraws=0)
+    base.redraw = lambda: setattr(base, 'redraws', base.redraws + 1)
+    return NetworkInstructions()
+
+
+def testZoneDiff():
+    zones = [
+        [],
+        [(0, False), (1, False), (-1, True)],
+        [(1, False), (-1, True), (0, False), (5, True)],
+        [(5, True), (1, False), (-1, True), (0, False)],
+        [(-1, True), (-1, True), (1, False)],
+        [(2, False)],
+        []]
+    game, p0, p1 = util.newGame([dummyCards.one() for i in range(6)])
+    instructions = clientInstructions(game)
+    try:
+        zoneIndex = p0.zones.index(p0.hand)
+        p0.hand[:] = []
+        for i, (old, new) in enumerate(zip(zones, zones[1:])):
+            instructions.updateZone(zoneIndex, False, *zoneDiff(old, new))
+            # Nothing shows until the redraw is over
+            assert len(p0.hand) == len(old)
+            instructions.endRedraw()
+            assert base.redraws == i + 1
+            assert [(c.cardId, c.owner is p1) for c in p0.hand] == new
+    finally:
+        del builtins.base
+
+    assert zoneDiff(zones[2], zones[2]) == []
+    # Adding to the end doesn't resend the rest
+    assert zoneDiff(zones[5], zones[5] + [(3, True)]) == [
+        network.ZoneOp.insert, 1, 3, True]
+
+
+def testAsyncLobbyHostsGames():
+    async def play():
+        lobby = LobbyServer(['--asyncio'], port=0)
+        port = lobby.networkManager.sock.getsockname()[1]
+        server = asyncio.ensure_future(lobby.networkManager.serve())
+
+        clients = []
+        for i in range(2):
+            base = RecordingClient()
+            netman = network.AsyncClientNetworkManager(
+                base, 'localhost', port)
+            # The 2nd client is old and only speaks text
+            netman.features = (
+                network.Features.binary | network.Features.delta
+                if i == 0 else 0)
+            await netman.connect(('localhost', port))
+            clients.append((netman, base))
+
+        await waitFor(lambda: len(lobby.networkManager.connections) == 2)
+        await waitFor(lambda: clients[0][0].connections[0].binary)
+        assert [c.binary for c in lobby.networkManager.connections] == [
+            True, False]
+
+        for netman, base in clients:
+            netman.addPlayer()
+        await waitFor(lambda: len(lobby.hostedGames) == 1)
+        assert len(lobby.networkManager.connections) == 0
+
+        for netman, base in clients:
+            await waitFor(lambda: base.got('onEnteredGame'))
+            netman.selectFaction(0)
+
+        await waitFor(lambda: any(
+            base.got('requestGoingFirstDecision') for n, base in clients))
+        for netman, base in clients:
+            if base.got('requestGoingFirstDecision'):
+                netman.decideWhetherToGoFirst(1)
+
+        for netman, base in clients:
+            await waitFor(lambda: base.got('endRedraw'))
+        assert clients[0][1].got('updateZone')
+        assert not clients[0][1].got('updatePlayerHand')
+        assert clients[1][1].got('updatePlayerHand')
+
+        # The player that stays wins and goes back to the lobby
+        clients[0][0].connections[0].close()
+        await waitFor(lambda: len(lobby.hostedGames) == 0)
+        await waitFor(lambda: clients[1][1].got('winGame'))
+        assert len(lobby.networkManager.connections) == 1
+
+        server.cancel()
+
+    asyncio.run(play())
+
+
+def startGame(lobby, started):
+    """
+    Have 2 clients start a game through a synchronous lobby. started
+    tells whether the game has been handed off. Returns the clients, a
+    function that polls everything until a condition holds, and the
+    lobby's connections to the clients.
+    """
+    port = lobby.networkManager.sock.getsockname()[1]
+    clients = []
+
+    def pumpUntil(condition):
+        for i in range(200):
+            if condition():
+                return
+            lobby.acceptConnections(0.01)
+            for netman, base in clients:
+                netman.recv(0)
+        assert condition()
+
+    for i in range(2):
+        base = RecordingClient()
+        netman = network.ClientNetworkManager(base, 'localhost', port)
+        netman.connect(('localhost', port))
+        clients.append((netman, base))
+
+    pumpUntil(lambda: len(lobby.networkManager.connections) == 2)
+    accepted = list(lobby.networkManager.connections)
+    for netman, base in clients:
+        netman.addPlayer()
+    pumpUntil(started)
+    assert len(lobby.networkManager.connections) == 0
+
+    for netman, base in clients:
+        pumpUntil(lambda: base.got('onEnteredGame'))
+        netman.selectFaction(0)
+
+    pumpUntil(lambda: any(
+        base.got('requestGoingFirstDecision') for n, base in clients))
+    for netman, base in clients:
+        if base.got('requestGoingFirstDecision'):
+            netman.decideWhetherToGoFirst(1)
+
+    for netman, base in clients:
+        pumpUntil(lambda: base.got('endRedraw'))
+
+    return clients, pumpUntil, accepted
+
+
+def playGame(lobby, started, leave=lambda netman: netman.close()):
+    """
+    Have 2 clients play a game through a synchronous lobby until one of
+    them leaves. started tells whether the game has been handed off.
+    leave makes the first client leave, given its network manager. It
+    isn't polled after that. Returns the lobby's connections to them, the
+    leaver first.
+    """
+    clients, pumpUntil, accepted = startGame(lobby, started)
+
+    # The player that stays wins and goes back to the lobby
+    leaver, base = clients.pop(0)
+    leave(leaver)
+    pumpUntil(lambda: clients[0][1].got('winGame'))
+    pumpUntil(lambda: len(lobby.networkManager.connections) == 1)
+    leaver.close()
+    return accepted
+
+
+def testCountsAreDebounced():
+    lobby = LobbyServer([], port=0)
+    lobby.countInterval = 0.2
+    port = lobby.networkManager.sock.getsockname()[1]
+    clients = []
+
+    def pump(condition=lambda: False):
+        for i in range(50):
+            if condition():
+                return
+            lobby.acceptConnections(0.01)
+            for netman, base in clients:
+                netman.recv(0)
+
+    # Everyone connects at once
+    for i in range(5):
+        base = RecordingClient()
+        netman = network.ClientNetworkManager(base, 'localhost', port)
+        netman.connect(('localhost', port))
+        clients.append((netman, base))
+        lobby.acceptConnections(0)
+    pump(lambda: all(base.got('updateNumPlayers') for n, base in clients))
+    pump()
+
+    for netman, base in clients:
+        assert base.got('updateNumPlayers') == [(5,)]
+    assert lobby.countsSent == 5
+
+    # Nothing's changed, so nobody needs telling
+    lobby.updateNumPlayers()
+    pump()
+    assert lobby.countsSent == 5
+    assert lobby.countsSuppressed == 5
+
+    # Except the player that asks
+    clients[0][0].requestNumPlayers()
+    pump(lambda: len(clients[0][1].got('updateNumPlayers')) == 2)
+    assert clients[0][1].got('updateNumPlayers') == [(5,), (5,)]
+
+    # Leaving closes the lobby's end
+    conn = lobby.networkManager.connections[0]
+    clients.pop(0)[0].close()
+    pump(lambda: len(lobby.networkManager.connections) == 4)
+    assert conn.fileno() == -1
+
+    for netman, base in clients:
+        netman.close()
+    lobby.networkManager.sock.close()
+
+
+def testIdleConnectionsAreDropped():
+    lobby = LobbyServer(['--idle-timeout', '0.2'], port=0)
+    lobby.networkManager.probeTimeout = 0.1
+    lobby.networkManager.idleWheel = TimerWheel(tickLength=0.05)
+    lobby.networkManager.reapUnprobeable = True
+    port = lobby.networkManager.sock.getsockname()[1]
+    clients = []
+
+    # One answers pings and one can't
+    for features in (network.Features.heartbeat, 0):
+        base = RecordingClient()
+        netman = network.ClientNetworkManager(base, 'localhost', port)
+        netman.features = features
+        netman.connect(('localhost', port))
+        clients.append((netman, base))
+        lobby.acceptConnections(0)
+
+    dropped = []
+    for i in range(100):
+        lobby.acceptConnections(0.01)
+        for netman, base in clients:
+            try:
+                netman.recv(0)
+            except ConnectionClosed:
+                dropped.append(netman)
+                clients.remove((netman, base))
+
+    assert len(lobby.networkManager.connections) == 1
+    assert len(dropped) == 1
+    assert dropped[0].features == 0
+
+    clients[0][0].close()
+    lobby.networkManager.sock.close()
+
+
+def testIdleLegacyPlayersAreKept():
+    """
+    Clients that can't answer pings aren't dropped, whether they're in a
+    game or waiting for one
+    """
+    lobby = LobbyServer(['--idle-timeout', '0.3'], port=0)
+    lobby.networkManager.idleWheel = TimerWheel(tickLength=0.05)
+    port = lobby.networkManager.sock.getsockname()[1]
+    clients = []
+
+    for i in range(3):
+        base = RecordingClient()
+        netman = network.ClientNetworkManager(base, 'localhost', port)
+        netman.features = 0
+        netman.connect(('localhost', port))
+        clients.append((netman, base))
+        lobby.acceptConnections(0)
+    for netman, base in clients:
+        netman.addPlayer()
+
+    for i in range(60):
+        lobby.acceptConnections(0.01)
+        for netman, base in clients:
+            netman.recv(0)
+
+    assert len(lobby.hostedGames) == 1
+    game, = lobby.hostedGames
+    assert len(game.networkManager.connections) == 2
+    assert len(lobby.readyPlayers) == 1
+    assert len(lobby.networkManager.connections) == 1
+
+    for netman, base in clients:
+        netman.close()
+    lobby.networkManager.sock.close()
+
+
+def testQuietPlayersAreDroppedFromGames():
+    lobby = LobbyServer(['--idle-timeout', '0.3'], port=0)
+    lobby.networkManager.probeTimeout = 0.1
+    lobby.networkManager.idleWheel = TimerWheel(tickLength=0.05)
+    # The leaver stops answering pings
+    left, stayed = playGame(
+        lobby, lambda: len(lobby.hostedGames) == 1, lambda netman: None)
+    assert len(lobby.hostedGames) == 0
+    assert left.fileno() == -1
+    lobby.networkManager.sock.close()
+
+
+def testFloodersAreDropped():
+    lobby = LobbyServer([], port=0)
+    port = lobby.networkManager.sock.getsockname()[1]
+    base = RecordingClient()
+    netman = network.ClientNetworkManager(base, 'localhost', port)
+    netman.connect(('localhost', port))
+    lobby.acceptConnections(0)
+
+    with netman.batched(netman.connections[0]):
+        for i in range(300):
+            netman.requestNumPlayers()
+
+    dropped = False
+    for i in range(100):
+        lobby.acceptConnections(0.01)
+        try:
+            netman.recv(0)
+        except ConnectionClosed:
+            dropped = True
+            break
+
+    assert dropped
+    assert len(lobby.networkManager.connections) == 0
+    # Only the burst got through
+    assert len(base.got('updateNumPlayers')) <= 12
+
+    lobby.networkManager.sock.close()
+
+
+def testFloodersAreDroppedFromGames():
+    def flood(netman):
+        # Wrong arity, so they're thrown away, but they still count
+        with netman.batched(netman.connections[0]):
+            for i in range(400):
+                netman.attack(1)
+
+    lobby = LobbyServer([], port=0)
+    left, stayed = playGame(
+        lobby, lambda: len(lobby.hostedGames) == 1, flood)
+    assert len(lobby.hostedGames) == 0
+    assert left.fileno() == -1
+    lobby.networkManager.sock.close()
+
+
+def testHugeFramesEndGames():
+    def sendHugeFrame(netman):
+        netman.connections[0].conn.sendall(b'i1' * 35 * 1024)
+
+    lobby = LobbyServer([], port=0)
+    left, stayed = playGame(
+        lobby, lambda: len(lobby.hostedGames) == 1, sendHugeFrame)
+    assert len(lobby.hostedGames) == 0
+    assert left.fileno() == -1
+    lobby.networkManager.sock.close()
+
+
+def testGamesSurviveClosedSockets():
+    """
+    A socket closed underneath a game only ends that game
+    """
+    lobby = LobbyServer([], port=0)
+    clients, pumpUntil, (left, stayed) = startGame(
+        lobby, lambda: len(lobby.hostedGames) == 1)
+
+    # Telling the one that stays they won fails
+    stayed.conn.close()
+    clients[0][0].close()
+    # Only poll the lobby
+    players = [netman for netman, base in clients]
+    clients.clear()
+    pumpUntil(lambda: len(lobby.hostedGames) == 0)
+
+    # The lobby still works
+    base = RecordingClient()
+    port = lobby.networkManager.sock.getsockname()[1]
+    netman = network.ClientNetworkManager(base, 'localhost', port)
+    netman.connect(('localhost', port))
+    clients.append((netman, base))
+    pumpUntil(lambda: base.got('updateNumPlayers'))
+
+    for netman in players + [netman]:
+        netman.close()
+    lobby.networkManager.sock.close()
+
+
+def testLobbyHostsGames():
+    lobby = LobbyServer([], port=0)
+    left, stayed = playGame(lobby, lambda: len(lobby.hostedGames) == 1)
+    assert len(lobby.hostedGames) == 0
+    assert left.fileno() == -1
+    assert stayed.fileno() != -1
+    assert lobby.gameServerProcs == {}
+    lobby.networkManager.sock.close()
+
+
+def testWorkerPool():
+    lobby = LobbyServer(['--workers', '2'], port=0)
+    workers = lobby.workerPool.workers
+    playGame(lobby, lambda: sum(w.load for w in workers) == 1)
+    assert [w.load for w in workers] == [0, 0]
+    lobby.workerPool.close()
+    lobby.networkManager.sock.close()
+
+
+def testWorkerSurvivesDisconnectAndPacket():
+    """
+    One player leaving finishes the game and hands the other back to the
+    lobby, even if the other's packet comes in the same select.
+    """
+    lobby = LobbyServer([], port=0)
+    port = lobby.networkManager.sock.getsockname()[1]
+    lobbySide, workerSide = socket.socketpair(
+        socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    worker = GameWorker(lobby.networkManager.split([]), workerSide)
+    clients = []
+
+    for i in range(2):
+        base = RecordingClient()
+        netman = network.ClientNetworkManager(base, 'localhost', port)
+        netman.connect(('localhost', port))
+        clients.append((netman, base))
+        lobby.acceptConnections(0.1)
+
+    connections = list(lobby.networkManager.connections)
+    for c in connections:
+        lobby.networkManager.removeConnection(c)
+    sendConnections(lobbySide, connections, 0)
+    worker.networkManager.recv(0.1)
+    assert len(worker.games) == 1
+    recvConnections(lobbySide, lobby.networkManager.connectionClass)
+    for i in range(5):
+        worker.networkManager.recv(0.01)
+        for netman, base in clients:
+            netman.recv(0)
+
+    # Both are waiting by the time the worker looks, the leaver first
+    clients[0][0].close()
+    time.sleep(0.02)
+    clients[1][0].selectFaction(0)
+    time.sleep(0.02)
+    worker.networkManager.recv(0)
+
+    assert worker.games == {}
+    info, returned = recvConnections(
+        lobbySide, lobby.networkManager.connectionClass)
+    assert [c.addr for c in returned] == [connections[1].addr]
+
+    for c in returned:
+        c.close()
+    clients[1][0].close()
+    lobbySide.close()
+    workerSide.close()
+    lobby.networkManager.sock.close()
+
+
+def testShardsMatchAcrossShards():
+    controls = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                for i in range(2)]
+    coordinator = Coordinator([c for c, s in controls])
+    coordinator.countInterval = 0
+    # Give them their own ports so we know which shard each player is on
+    shards = [LobbyServer([], port=0, shard=s) for c, s in controls]
+    clients = []
+
+    def pumpUntil(condition):
+        for i in range(200):
+            if condition():
+                return
+            coordinator.networkManager.recv(0)
+            for shard in shards:
+                shard.acceptConnections(0.005)
+            for netman, base in clients:
+                netman.recv(0)
+        assert condition()
+
+    for shard in shards:
+        port = shard.networkManager.sock.getsockname()[1]
+        base = RecordingClient()
+        netman = network.ClientNetworkManager(base, 'localhost', port)
+        netman.connect(('localhost', port))
+        clients.append((netman, base))
+
+    # Both shards know there are 2 players in all
+    pumpUntil(lambda: all(
+        base.got('updateNumPlayers')[-1:] == [(2,)] for n, base in clients))
+
+    for netman, base in clients:
+        netman.addPlayer()
+    pumpUntil(lambda: sum(len(s.hostedGames) for s in shards) == 1)
+    for netman, base in clients:
+        pumpUntil(lambda: base.got('onEnteredGame'))
+
+    for netman, base in clients:
+        netman.close()
+    for shard in shards:
+        shard.networkManager.sock.close()
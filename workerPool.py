@@ -0,0 +1,217 @@
+"""
+A pool of worker processes started along with the lobby. Matched players'
+sockets are handed to the least loaded worker, which hosts their game.
+When the game ends, the sockets of the players still connected are handed
+back to the lobby.
+
+Only works on Unix, since it passes sockets between processes.
+"""
+
+import os
+import pickle
+import random
+import socket
+
+from gameServer import GameServer
+
+
+# Plenty for a message and the fds of one match
+maxMessageSize = 1024 * 1024
+maxFds = 16
+
+
+def getState(conn):
+    """
+    Get what the other process needs to carry on with conn
+    """
+    return (conn.addr, conn.features, conn.binary,
+            bytes(conn.buffer[conn.frameStart:]), bytes(conn.outbox))
+
+
+def sendConnections(control, connections, info):
+    """
+    Send connections over the control socket, along with info, e.g. how
+    many games the sender is running. Closes our copies of their sockets.
+    """
+    message = pickle.dumps((info, [getState(c) for c in connections]))
+    socket.send_fds(
+        control, [message], [c.conn.fileno() for c in connections])
+    for c in connections:
+        c.conn.close()
+
+
+def recvConnections(control, connectionClass):
+    """
+    Get (info, connections) sent by sendConnections, or None if the other
+    end has closed the control socket.
+    """
+    message, fds, flags, addr = socket.recv_fds(
+        control, maxMessageSize, maxFds)
+    if message == b'':
+        return None
+
+    info, states = pickle.loads(message)
+    connections = []
+    for fd, (addr, features, binary, buffer, outbox) in zip(fds, states):
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(0)
+        conn = connectionClass(sock, addr)
+        conn.features, conn.binary = features, binary
+        conn.buffer += buffer
+        conn.outbox += outbox
+        connections.append(conn)
+
+    return info, connections
+
+
+class Worker:
+    """
+    The lobby's handle on a worker process
+    """
+    def __init__(self, pid, control):
+        self.pid, self.control = pid, control
+        # How many games it's running
+        self.load = 0
+
+
+class WorkerPool:
+    def __init__(self, netman, size, onPlayersReturned):
+        """
+        Start size workers. netman is the lobby's NetworkManager.
+        onPlayersReturned is called with the connections of players
+        whose game is over, after they've been added to netman.
+        """
+        self.networkManager = netman
+        self.onPlayersReturned = onPlayersReturned
+        self.workers = []
+        for i in range(size):
+            self.workers.append(self.startWorker())
+
+    def startWorker(self):
+        lobbySide, workerSide = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        pid = os.fork()
+        if pid == 0:
+            lobbySide.close()
+            # Don't keep the lobby's sockets open
+            self.networkManager.sock.close()
+            for c in self.networkManager.connections:
+                c.conn.close()
+            for worker in self.workers:
+                worker.control.close()
+
+            random.seed()  # Regenerate the random seed for this worker
+            try:
+                GameWorker(self.networkManager.split([]), workerSide).run()
+            finally:
+                # Don't run the lobby's cleanup in here
+                os._exit(0)
+
+        workerSide.close()
+        worker = Worker(pid, lobbySide)
+        self.networkManager.addReader(
+            lobbySide, lambda: self.onMessage(worker))
+        return worker
+
+    def hostGame(self, connections):
+        """
+        Hand connections to the least loaded worker to play a game.
+        """
+        worker = min(self.workers, key=lambda w: w.load)
+        for c in connections:
+            self.networkManager.removeConnection(c)
+        sendConnections(worker.control, connections, 0)
+        # Count it now so matches made before it reports go elsewhere
+        worker.load += 1
+
+    def onMessage(self, worker):
+        received = recvConnections(
+            worker.control, self.networkManager.connectionClass)
+
+        if received is None:  # It died. Its players went with it
+            print("Game worker " + str(worker.pid) + " died. Restarting.")
+            self.networkManager.removeReader(worker.control)
+            worker.control.close()
+            os.waitpid(worker.pid, 0)
+            self.workers[self.workers.index(worker)] = self.startWorker()
+            return
+
+        worker.load, connections = received
+        for c in connections:
+            self.networkManager.addConnection(c)
+        if len(connections) > 0:
+            self.onPlayersReturned(connections)
+
+    def close(self):
+        """
+        Stop the workers. They finish when they see the control socket close.
+        """
+        for worker in self.workers:
+            self.networkManager.removeReader(worker.control)
+            worker.control.close()
+        for worker in self.workers:
+            os.waitpid(worker.pid, 0)
+        self.workers = []
+
+
+class GameWorker:
+    """
+    Runs in a worker process and hosts the games the lobby sends it.
+    """
+    def __init__(self, netman, control):
+        self.networkManager = netman
+        self.networkManager.base = self
+        self.control = control
+        # Each game and the connections it was started with
+        self.games = {}
+        self.running = True
+        netman.addReader(control, self.onMessage)
+
+    def onMessage(self):
+        received = recvConnections(
+            self.control, self.networkManager.connectionClass)
+        if received is None:  # The lobby is gone
+            self.running = False
+            return
+
+        info, connections = received
+        for c in connections:
+            self.networkManager.addConnection(c)
+
+        game = GameServer(
+            self.networkManager.subManager(connections),
+            onFinished=self.onGameFinished)
+        self.games[game] = connections
+        self.reportLoad()
+
+        # Handle anything they sent before the handoff
+        for c in connections:
+            if c.frameStart < len(c.buffer):
+                self.networkManager.dispatch(
+                    c.manager, c.manager.onGotData, c, b'')
+
+    def onGameFinished(self, game, status):
+        """
+        Send the players that are still here back to the lobby
+        """
+        connections = self.games.pop(game, None)
+        if connections is None:  # Already sent them back
+            return
+
+        stillHere = [
+            c for c in connections if c in game.networkManager.connections]
+        for c in connections:
+            if c in stillHere:
+                game.networkManager.removeConnection(c)
+            else:
+                c.close()
+
+        sendConnections(self.control, stillHere, len(self.games))
+
+    def reportLoad(self):
+        sendConnections(self.control, [], len(self.games))
+
+    def run(self):
+        while self.running:
+            self.networkManager.recv(None)